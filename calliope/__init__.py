@@ -58,6 +58,7 @@ else:
     from . import diff
     from . import export
     from . import import_
+    from . import select
     from . import shuffle
     from . import stat
     from . import sync
@@ -17,14 +17,31 @@
 
 import xdg.BaseDirectory
 
+import atexit
+import collections
+import concurrent.futures
 import contextlib
-import dbm.gnu
-import errno
+import fcntl
 import json
 import io
 import logging
 import os
+import re
+import sqlite3
+import struct
+import threading
 import time
+import weakref
+import zlib
+
+try:
+    import dbm.gnu
+    HAVE_GDBM = True
+except ImportError:
+    # Some distributions package the GDBM bindings separately from Python.
+    HAVE_GDBM = False
+
+import calliope
 
 log = logging.getLogger(__name__)
 
@@ -47,8 +64,36 @@ class Cache():
     Do not use this class directly. Call the `open()` module method instead.
 
     '''
-    def __init__(self, namespace, cachedir=None):
-        raise NotImplementedError("Use the cache.open() function to open a cache")
+    def __init__(self):
+        # Maximum age of a cache entry in seconds, or None if entries never
+        # expire. See the `wrap()` method.
+        self.ttl = None
+        # Maximum age of a negative entry in seconds. See `store_negative()`.
+        self.negative_ttl = DEFAULT_NEGATIVE_TTL
+        self.stale_while_revalidate = False
+        self.single_flight = False
+
+        # Whether to compress new entries. See `_encode_many()`.
+        self.compress = False
+        self._zdicts = {0: None}
+        self._zdict_id = None
+        self._zdict_samples = []
+        self._zdict_samples_size = 0
+        self._zdict_mutex = threading.RLock()
+
+        # Counters which are added to the totals saved in the cache when it
+        # is closed, or when the process exits. See `stats()`.
+        self._lookup_count = 0
+        self._hit_count = 0
+        _unclosed_caches.add(self)
+
+        # Path of the file used to lock individual keys for 'single_flight'.
+        # Subclasses must set this.
+        self._key_locks_path = None
+
+        self._refresher = None
+        self._refreshing = {}
+        self._refresh_mutex = threading.Lock()
 
     def lookup(self, key):
         '''Lookup 'key' in the cache.
@@ -56,7 +101,11 @@ class Cache():
         Returns a tuple of (found, value).
 
         '''
-        raise NotImplementedError()
+        values = self.lookup_many([key])
+        if key in values:
+            return True, values[key]
+        else:
+            return False, None
 
     def store(self, key, value):
         '''Store 'value' in the cache under the given key.
@@ -64,65 +113,360 @@ class Cache():
         The contents of 'value' must be representable as JSON data.
 
         '''
+        self.store_many({key: value})
+
+    def store_negative(self, key):
+        '''Record that there is no value for 'key'.
+
+        This is for when a remote API has no result for a query. Looking up
+        the key returns NOT_FOUND, which is distinct from a stored None
+        value. Negative entries expire after 'negative_ttl' seconds, so the
+        query is retried from time to time in case the remote data has
+        changed. You can also return NOT_FOUND from the function passed to
+        `wrap()`.
+
+        '''
+        self.store_many({key: NOT_FOUND})
+
+    def lookup_entry(self, key):
+        '''Return the Entry stored for 'key', even if it has expired.
+
+        Returns None if the key isn't in the cache.
+
+        '''
+        return self._lookup_entries([key]).get(key)
+
+    def get_persistent(self, name):
+        '''Return a value saved with `set_persistent()`, or None.'''
+        key = _PERSISTENT_KEY.format(name)
+        found = self._read([key])
+        if key not in found:
+            return None
+        return json.loads(bytes(found[key]))
+
+    def set_persistent(self, name, value):
+        '''Save a value that isn't a query result, such as a login token.
+
+        Persistent values never expire, and they are left out of `keys()`, so
+        they aren't pruned or exported along with the cache entries.
+
+        '''
+        self._write({_PERSISTENT_KEY.format(name): _dumps(value)})
+        self.flush()
+
+    def lookup_many(self, keys):
+        '''Lookup several keys in the cache at once.
+
+        Returns a dict which maps each key that was found to its value. Keys
+        that are not in the cache, or whose entries have expired, are left out.
+
+        '''
+        keys = list(keys)
+        now = time.time()
+        result = {key: entry.value
+                  for key, entry in self._lookup_entries(keys).items()
+                  if self._is_fresh(entry, now)}
+        self._lookup_count += len(keys)
+        self._hit_count += len(result)
+        return result
+
+    def store_many(self, values):
+        '''Store every key and value from the 'values' dict in the cache.'''
+        self._write(self._encode_many(values, time.time()))
+
+    def _lookup_entries(self, keys):
+        # Return an Entry for each key that was found, even if it's expired.
+        return {key: self._decode_entry(key, data)
+                for key, data in self._read(keys).items()}
+
+    def _encode_many(self, values, stored_at):
+        # Returns a dict of encoded entries to pass to _write().
+        #
+        # If 'compress' is set, values are compressed with zlib. Most of the
+        # values in a namespace look alike, so we train a preset dictionary
+        # from the first DICTIONARY_SAMPLE_SIZE bytes of values that get
+        # stored and save it in the cache alongside them. The dictionary is
+        # then used for all later entries. Each entry records the ID of the
+        # dictionary it was compressed with, so if two processes race to
+        # train one the entries from both remain readable.
+        if not self.compress:
+            return {key: _encode(value, stored_at)
+                    for key, value in values.items()}
+
+        negative = {key: _encode(NOT_FOUND, stored_at)
+                    for key, value in values.items() if value is NOT_FOUND}
+        values = {key: value for key, value in values.items()
+                  if value is not NOT_FOUND}
+
+        with self._zdict_mutex:
+            if self._zdict_id is None:
+                found = self._read([_CURRENT_ZDICT_KEY])
+                if _CURRENT_ZDICT_KEY in found:
+                    zdict_id, = _ZDICT_ID.unpack(found[_CURRENT_ZDICT_KEY])
+                    self._get_zdict(zdict_id)
+                    self._zdict_samples = None
+                else:
+                    zdict_id = 0
+                self._zdict_id = zdict_id
+
+            result = {}
+            for key, value in values.items():
+                text = _dumps(value)
+                result[key] = _compress(text, stored_at, self._zdict_id,
+                                        self._zdicts[self._zdict_id])
+                if self._zdict_samples is not None:
+                    self._zdict_samples.append(text)
+                    self._zdict_samples_size += len(text)
+
+            if (self._zdict_samples is not None and
+                    self._zdict_samples_size >= DICTIONARY_SAMPLE_SIZE):
+                zdict = _train_zdict(self._zdict_samples, DICTIONARY_SIZE)
+                self._zdict_samples = None
+                if zdict:
+                    zdict_id = zlib.crc32(zdict)
+                    log.debug("Trained a %i byte compression dictionary",
+                              len(zdict))
+                    self._zdicts[zdict_id] = zdict
+                    self._zdict_id = zdict_id
+                    result[_ZDICT_KEY.format(zdict_id)] = zdict
+                    result[_CURRENT_ZDICT_KEY] = _ZDICT_ID.pack(zdict_id)
+        result.update(negative)
+        return result
+
+    def _decode_entry(self, key, data):
+        if isinstance(data, bytes) and data[0] == _HEADER_MARKER:
+            marker, flags, stored_at = _HEADER.unpack_from(data)
+            if flags & _FLAG_NEGATIVE:
+                return Entry(NOT_FOUND, stored_at)
+            if flags & _FLAG_ZLIB:
+                zdict_id, = _ZDICT_ID.unpack_from(data, _HEADER.size)
+                zdict = self._get_zdict(zdict_id)
+                offset = _HEADER.size + _ZDICT_ID.size
+                if zdict is None:
+                    text = zlib.decompress(data[offset:])
+                else:
+                    text = zlib.decompressobj(zdict=zdict).decompress(
+                        data[offset:])
+                return Entry(json.loads(text), stored_at)
+        entry = _decode(data)
+        if (entry.value is None and entry.stored_at is None and
+                key.startswith(LEGACY_NEGATIVE_PREFIXES)):
+            # See LEGACY_NEGATIVE_PREFIXES.
+            return Entry(NOT_FOUND, None)
+        return entry
+
+    def _get_zdict(self, zdict_id):
+        with self._zdict_mutex:
+            if zdict_id not in self._zdicts:
+                key = _ZDICT_KEY.format(zdict_id)
+                found = self._read([key])
+                if key not in found:
+                    raise RuntimeError("Cache entry was compressed with a "
+                                       "dictionary that is missing from the "
+                                       "cache.")
+                self._zdicts[zdict_id] = bytes(found[key])
+            return self._zdicts[zdict_id]
+
+    def _reread_entries(self, keys):
+        # Like _lookup_entries(), but ignoring any copies kept in memory.
+        return self._lookup_entries(keys)
+
+    def _is_fresh(self, entry, now):
+        ttl = self.ttl
+        if entry.value is NOT_FOUND and self.negative_ttl is not None:
+            ttl = self.negative_ttl
+        if ttl is None:
+            return True
+        if entry.stored_at is None:
+            # Entries written by older versions of Calliope don't record when
+            # they were stored, so we treat them as expired.
+            return False
+        return now - entry.stored_at < ttl
+
+    def _read(self, keys):
+        # Return a dict with the encoded data for each key that was found.
         raise NotImplementedError()
 
+    def _write(self, entries):
+        # Store the encoded data for each key in the 'entries' dict.
+        raise NotImplementedError()
 
-class GdbmCache:
-    '''Cache implementation which uses the GNU DBM library.'''
+    def _keys(self):
+        # Return a list of every key in the cache, including reserved keys.
+        raise NotImplementedError()
 
-    # GDBM does not support concurrent writers & readers. To work around this
-    # we re-open the database on every read and write. This probably has a
-    # performance penalty.
+    def _delete(self, keys):
+        # Remove the given keys from the cache, if present.
+        raise NotImplementedError()
 
-    def __init__(self, namespace, cachedir=None):
-        if cachedir is None:
-            cachedir = xdg.BaseDirectory.save_cache_path('calliope')
+    def keys(self):
+        '''Return a list of every key stored in the cache.'''
+        return [key for key in self._keys()
+                if not key.startswith(RESERVED_KEY_PREFIX)]
 
-        self._path = os.path.join(cachedir, namespace) + '.gdbm'
+    def items(self):
+        '''Iterate over every key in the cache with its Entry.
 
-    def lookup(self, key):
-        '''Lookup 'key' in the cache.
+        Expired entries are included.
 
-        Returns a tuple of (found, value).
+        '''
+        keys = self.keys()
+        for i in range(0, len(keys), ITERATION_CHUNK_SIZE):
+            chunk = keys[i:i+ITERATION_CHUNK_SIZE]
+            entries = self._lookup_entries(chunk)
+            for key in chunk:
+                if key in entries:
+                    yield key, entries[key]
+
+    def delete_many(self, keys):
+        '''Remove the given keys from the cache.'''
+        self._delete(list(keys))
+
+    def prune(self, prefix=None, stored_before=None):
+        '''Remove the entries that match all of the given conditions.
+
+        The 'prefix' parameter matches keys beginning with the given text.
+        The 'stored_before' parameter is a Unix timestamp. It matches
+        entries stored before then, along with entries written by older
+        versions of Calliope, which don't record when they were stored.
+
+        Returns the number of entries removed.
 
         '''
-        if not os.path.exists(self._path):
-            return False, None
-        with dbm.gnu.open(self._path, 'r') as db:
-            if key in db:
-                return True, json.loads(db[key])
+        keys = self.keys()
+        if prefix is not None:
+            keys = [key for key in keys if key.startswith(prefix)]
+        if stored_before is not None:
+            matched = []
+            for i in range(0, len(keys), ITERATION_CHUNK_SIZE):
+                chunk = keys[i:i+ITERATION_CHUNK_SIZE]
+                for key, data in self._read(chunk).items():
+                    stored_at = _decode_stored_at(data)
+                    if stored_at is None or stored_at < stored_before:
+                        matched.append(key)
+            keys = matched
+        self.delete_many(keys)
+        return len(keys)
+
+    def compact(self):
+        '''Reclaim the disk space left unused by deleted or replaced entries.'''
+        pass
+
+    def size_on_disk(self):
+        '''Return the total size in bytes of the files used by the cache.'''
+        return 0
+
+    def stats(self, separator=':'):
+        '''Return a dict of statistics about the contents of the cache.
+
+        Keys are grouped by the text before the first 'separator'. The
+        'prefixes' item maps each group to a tuple of (entries, bytes). The
+        'lookups' and 'hits' items count cache lookups over all processes
+        that have closed the cache properly.
+
+        '''
+        prefixes = collections.defaultdict(lambda: [0, 0])
+        entries = 0
+        total_bytes = 0
+        keys = self.keys()
+        for i in range(0, len(keys), ITERATION_CHUNK_SIZE):
+            for key, data in self._read(keys[i:i+ITERATION_CHUNK_SIZE]).items():
+                size = len(key) + len(data)
+                group = prefixes[key.split(separator, 1)[0]]
+                group[0] += 1
+                group[1] += size
+                entries += 1
+                total_bytes += size
+
+        lookups, hits = self._load_lookup_counts()
+        return {
+            'entries': entries,
+            'bytes': total_bytes,
+            'size_on_disk': self.size_on_disk(),
+            'prefixes': {prefix: tuple(counts)
+                         for prefix, counts in prefixes.items()},
+            'lookups': lookups + self._lookup_count,
+            'hits': hits + self._hit_count,
+        }
+
+    def _load_lookup_counts(self):
+        found = self._read([_STATS_KEY])
+        if _STATS_KEY not in found:
+            return 0, 0
+        counts = json.loads(bytes(found[_STATS_KEY]))
+        return counts['lookups'], counts['hits']
+
+    def _save_lookup_counts(self):
+        # Two processes closing at once may lose some counts, which doesn't
+        # matter for statistics.
+        if self._lookup_count == 0:
+            return
+        lookups, hits = self._load_lookup_counts()
+        counts = {'lookups': lookups + self._lookup_count,
+                  'hits': hits + self._hit_count}
+        self._write({_STATS_KEY: _dumps(counts)})
+        self._lookup_count = self._hit_count = 0
+
+    def export(self, stream):
+        '''Write every entry in the cache to 'stream' as JSON.
+
+        Each line of output is an object with 'key', 'value' and 'stored_at'
+        properties. Negative entries have a 'negative' property set to true
+        instead of a value. Use `import_()` to load the entries into a cache.
+
+        '''
+        for key, entry in self.items():
+            if entry.value is NOT_FOUND:
+                item = {'key': key, 'negative': True}
             else:
-                return False, None
+                item = {'key': key, 'value': entry.value}
+            item['stored_at'] = entry.stored_at
+            json.dump(item, stream)
+            stream.write('\n')
 
-    @contextlib.contextmanager
-    def _open_for_writing(self):
-        # Open the database for writing. If it is currently locked for reading,
-        # wait a bit and try again.
+    def import_(self, stream):
+        '''Store the entries from 'stream', as written by `export()`.
 
-        MAX_RETRIES = 3
-        for attempt in range(1,MAX_RETRIES+1):
-            try:
-                db = dbm.gnu.open(self._path, 'cf')
-                yield db
-                db.close()
-
-                break   # Exit the retry loop -- we succeeded.
-            except dbm.gnu.error as e:
-                if e.errno == errno.EAGAIN:   # error 11 -- database is locked
-                    delay = 10**attempt
-                    log.debug("Database locked. Retrying in {} msec ({}/{}).".
-                              format(delay, attempt, MAX_RETRIES))
-                    time.sleep(delay * 0.001)
-                else:
-                    raise
-        else:
-            raise RuntimeError(
-                "Cache is locked -- unable to write despite {} attempts.".
-                format(attempt))
+        Returns the number of entries stored.
 
-    def store(self, key, value):
-        with self._open_for_writing() as db:
-            db[key] = json.dumps(value)
+        '''
+        count = 0
+        for line in stream:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            stored_at = item['stored_at']
+            if stored_at is None:
+                stored_at = time.time()
+            if item.get('negative'):
+                value = NOT_FOUND
+            else:
+                value = item['value']
+            self._write(self._encode_many({item['key']: value}, stored_at))
+            count += 1
+        self.flush()
+        return count
+
+    def flush(self):
+        '''Make sure stored values are visible to other processes.'''
+        pass
+
+    def close(self):
+        '''Release any resources held by the cache.
+
+        Background refreshes which haven't started yet are cancelled.
+
+        '''
+        with self._refresh_mutex:
+            refresher = self._refresher
+            futures = list(self._refreshing.values())
+            self._refresher = None
+        for future in futures:
+            future.cancel()
+        if refresher is not None:
+            refresher.shutdown(wait=True)
+        _unclosed_caches.discard(self)
+        self._save_lookup_counts()
 
     def wrap(self, key, call):
         '''Either run call() and save the result, or return cached result.
@@ -135,22 +479,804 @@ class GdbmCache:
                 entry = lastfm.cache.wrap('artist-similar:{}'.format(artist_name),
                     lambda: lastfm.api.artist.get_similar(artist_name, limit=count))
 
-        We currently have no mechanism for 'cache expiry'.
+        If the cache has a 'ttl' set, entries older than 'ttl' seconds have
+        expired. An expired entry is normally treated the same as a missing
+        one. If 'stale_while_revalidate' is set then the expired value is
+        returned straight away, and call() is run in a background thread to
+        refresh the cache entry for next time. At most MAX_PENDING_REFRESHES
+        refreshes are queued, and queued refreshes are cancelled when the
+        cache is closed, so that a run doesn't wait a long time to exit.
+
+        If call() returns NOT_FOUND, a negative entry is stored. See
+        `store_negative()`.
+
+        If 'single_flight' is set, only one process at a time runs call() for
+        a given key. Other processes that need the same key wait for the
+        first one to finish, then use the value that it stored. Each new
+        value is written out as soon as it is produced, so that the waiting
+        processes can see it.
 
         '''
-        found, entry = self.lookup(key)
-        if found:
-            log.debug("Found {} in cache".format(key))
-        else:
+        return self.wrap_many({key: call})[key]
+
+    def wrap_many(self, calls):
+        '''Like `wrap()`, for several keys at once.
+
+        The 'calls' parameter is a dict which maps each key to the function
+        that produces its value. Returns a dict which maps each key to the
+        cached or newly produced value.
+
+        The cache entries are all read in one operation, and any new values
+        are all stored in one operation.
+
+        '''
+        now = time.time()
+        entries = self._lookup_entries(calls.keys())
+        result = {}
+        new_values = {}
+        try:
+            for key, call in calls.items():
+                entry = entries.get(key)
+                self._lookup_count += 1
+                if entry is not None and self._is_fresh(entry, now):
+                    log.debug("Found {} in cache".format(key))
+                    result[key] = entry.value
+                    self._hit_count += 1
+                elif entry is not None and self.stale_while_revalidate:
+                    log.debug("Found expired {} in cache, refreshing in "
+                              "background".format(key))
+                    result[key] = entry.value
+                    self._refresh_in_background(key, call)
+                elif self.single_flight:
+                    result[key] = self._call_single_flight(key, call)
+                else:
+                    log.debug("Didn't find {} in cache, running remote query".format(key))
+                    result[key] = new_values[key] = call()
+        finally:
+            self.store_many(new_values)
+        return result
+
+    def warm(self, calls, max_workers=4):
+        '''Fill in missing cache entries ahead of time.
+
+        The 'calls' parameter is a dict which maps each key to the function
+        that produces its value, as for `wrap_many()`. Each function is run
+        if its entry is missing or has expired, with at most 'max_workers'
+        running at once. If a function raises an exception, a warning is
+        logged and the entry is left missing.
+
+        Returns the number of entries that were fetched.
+
+        '''
+        keys = list(calls)
+        now = time.time()
+        missing = []
+        for i in range(0, len(keys), ITERATION_CHUNK_SIZE):
+            chunk = keys[i:i+ITERATION_CHUNK_SIZE]
+            entries = self._lookup_entries(chunk)
+            missing += [key for key in chunk
+                        if key not in entries or
+                        not self._is_fresh(entries[key], now)]
+        log.debug("Warming %i of %i cache entries", len(missing), len(keys))
+
+        count = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            futures = {executor.submit(calls[key]): key for key in missing}
+            for future in concurrent.futures.as_completed(futures):
+                key = futures[future]
+                try:
+                    value = future.result()
+                except Exception as e:
+                    log.warning("Failed to fetch %s: %s", key, e)
+                    continue
+                self.store(key, value)
+                count += 1
+        self.flush()
+        return count
+
+    def _call_single_flight(self, key, call):
+        with _get_key_locks(self._key_locks_path).locked(key):
+            # Another process may have stored the value while we waited.
+            entry = self._reread_entries([key]).get(key)
+            if entry is not None and self._is_fresh(entry, time.time()):
+                log.debug("Found {} in cache after waiting".format(key))
+                return entry.value
+
             log.debug("Didn't find {} in cache, running remote query".format(key))
-            entry = call()
-            self.store(key, entry)
-        return entry
+            value = call()
+            self.store(key, value)
+            self.flush()
+            return value
+
+    def _refresh_in_background(self, key, call):
+        with self._refresh_mutex:
+            if key in self._refreshing:
+                return
+            if len(self._refreshing) >= MAX_PENDING_REFRESHES:
+                log.debug("Too many pending refreshes, not refreshing "
+                          "{}".format(key))
+                return
+            if self._refresher is None:
+                self._refresher = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1)
+            self._refreshing[key] = self._refresher.submit(
+                self._refresh, key, call)
+
+    def _refresh(self, key, call):
+        try:
+            self.store(key, call())
+        except Exception as e:
+            # The expired value stays in the cache, so we'll try again the
+            # next time that it's used.
+            log.warning("Unable to refresh {} in cache: {}".format(key, e))
+        finally:
+            with self._refresh_mutex:
+                del self._refreshing[key]
 
 
+class _NotFound():
+    def __repr__(self):
+        return 'NOT_FOUND'
 
 
-def open(namespace, cachedir=None):
+# The value of a negative entry. See `Cache.store_negative()`.
+NOT_FOUND = _NotFound()
+
+# Default lifetime for negative entries, in seconds.
+DEFAULT_NEGATIVE_TTL = 7 * 24 * 60 * 60
+
+# Older versions of Calliope stored None for artists that MusicBrainz or
+# Last.fm didn't know about. Plain None values under these key prefixes are
+# read as negative entries of unknown age, so they are looked up again once.
+LEGACY_NEGATIVE_PREFIXES = ('artist:', 'artist-top-tags:')
+
+# Maximum number of background refreshes that can be waiting at once. See
+# `Cache.wrap()`. Expired entries beyond this are refreshed on a later run.
+MAX_PENDING_REFRESHES = 20
+
+
+# An entry read from the cache. The 'stored_at' field is a Unix timestamp, or
+# None for entries that were written by older versions of Calliope.
+Entry = collections.namedtuple('Entry', ['value', 'stored_at'])
+
+
+# Cache entries are stored as a short header followed by the value encoded as
+# JSON. The header records when the entry was stored. Older versions of
+# Calliope stored plain JSON text with no header. JSON text never begins with
+# a zero byte, which is how the two are told apart.
+_HEADER = struct.Struct('!BBd')   # zero byte, flags, stored_at
+_HEADER_MARKER = 0
+
+# The value is compressed with zlib. The header is followed by the ID of the
+# preset dictionary that was used, or 0 if there was none.
+_FLAG_ZLIB = 0x01
+_ZDICT_ID = struct.Struct('!I')
+
+# The entry is negative and there is no value after the header.
+_FLAG_NEGATIVE = 0x02
+
+# Compression dictionaries are stored in the cache under these keys. Values
+# stored under them are raw bytes, not encoded entries.
+RESERVED_KEY_PREFIX = 'calliope.cache:'
+_CURRENT_ZDICT_KEY = RESERVED_KEY_PREFIX + 'zdict'
+_ZDICT_KEY = RESERVED_KEY_PREFIX + 'zdict:{:08x}'
+
+# Lookup counts from previous processes are stored under this key, as JSON.
+_STATS_KEY = RESERVED_KEY_PREFIX + 'stats'
+
+# Values saved with `Cache.set_persistent()` are stored under these keys, as
+# JSON.
+_PERSISTENT_KEY = RESERVED_KEY_PREFIX + 'persistent:{}'
+
+# Caches that haven't been closed yet. Their lookup counts are saved when the
+# process exits, as many callers never close their cache.
+_unclosed_caches = weakref.WeakSet()
+
+
+@atexit.register
+def _save_unclosed_caches():
+    for cache in list(_unclosed_caches):
+        try:
+            cache._save_lookup_counts()
+            cache.flush()
+        except Exception as e:
+            log.debug("Couldn't save lookup counts: %s", e)
+
+# How many entries to read at once when going through the whole cache.
+ITERATION_CHUNK_SIZE = 1000
+
+# How many bytes of values to collect before training a compression
+# dictionary, and the largest dictionary that zlib can make use of.
+DICTIONARY_SAMPLE_SIZE = 128 * 1024
+DICTIONARY_SIZE = 32 * 1024
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def _encode(value, stored_at):
+    if value is NOT_FOUND:
+        return _HEADER.pack(_HEADER_MARKER, _FLAG_NEGATIVE, stored_at)
+    return _HEADER.pack(_HEADER_MARKER, 0, stored_at) + _dumps(value)
+
+
+def _compress(text, stored_at, zdict_id, zdict):
+    if zdict is None:
+        compressor = zlib.compressobj(9)
+    else:
+        compressor = zlib.compressobj(9, zdict=zdict)
+    payload = compressor.compress(text) + compressor.flush()
+    if len(payload) + _ZDICT_ID.size >= len(text):
+        # Small values can come out bigger, so store those uncompressed.
+        return _HEADER.pack(_HEADER_MARKER, 0, stored_at) + text
+    return (_HEADER.pack(_HEADER_MARKER, _FLAG_ZLIB, stored_at) +
+            _ZDICT_ID.pack(zdict_id) + payload)
+
+
+def _decode(data):
+    if isinstance(data, str):
+        return Entry(json.loads(data), None)
+    if data[0] == _HEADER_MARKER:
+        marker, flags, stored_at = _HEADER.unpack_from(data)
+        if flags & _FLAG_NEGATIVE:
+            return Entry(NOT_FOUND, stored_at)
+        return Entry(json.loads(data[_HEADER.size:]), stored_at)
+    return Entry(json.loads(data), None)
+
+
+def _decode_stored_at(data):
+    # Read when an entry was stored without decoding the value.
+    if isinstance(data, bytes) and data[0] == _HEADER_MARKER:
+        return _HEADER.unpack_from(data)[2]
+    return None
+
+
+# JSON strings, including the ':' after an object key.
+_TOKEN = re.compile(rb'"(?:[^"\\]|\\.)*":?')
+
+
+def _train_zdict(samples, size):
+    '''Build a zlib preset dictionary from some sample values.
+
+    zlib treats the dictionary as if it came just before the data being
+    compressed, so it should contain the strings that turn up in many
+    values. We count how many samples each JSON string appears in, and pack
+    the most common into the dictionary, weighted by length. The most useful
+    strings go at the end, where zlib can refer to them most cheaply.
+
+    '''
+    counts = collections.Counter()
+    for sample in samples:
+        counts.update(set(_TOKEN.findall(sample)))
+
+    scored = sorted(((count * len(token), token)
+                     for token, count in counts.items() if count > 1),
+                    reverse=True)
+    tokens = []
+    total = 0
+    for score, token in scored:
+        if total + len(token) <= size:
+            tokens.append(token)
+            total += len(token)
+    return b''.join(reversed(tokens))
+
+
+class _KeyLocks():
+    '''Locks on individual cache keys, shared between processes.
+
+    Each key is hashed to one byte of a lock file, and that byte is locked
+    with fcntl(). The kernel releases the lock if the process holding it
+    dies, so a crashed process can't block the others forever. Occasionally
+    two keys will share a byte, which just means that they can't be fetched
+    at the same time.
+
+    Locks taken with fcntl() belong to the whole process, so threads within
+    a process are kept apart with a threading.Lock for each byte as well.
+    Use `_get_key_locks()` rather than creating this class directly, so that
+    there is only one instance for each lock file in the process.
+
+    '''
+    SLOTS = 1024 * 1024
+
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._thread_locks = collections.defaultdict(threading.Lock)
+        self._mutex = threading.Lock()
+
+    @contextlib.contextmanager
+    def locked(self, key):
+        slot = zlib.crc32(key.encode('utf-8')) % self.SLOTS
+        with self._mutex:
+            thread_lock = self._thread_locks[slot]
+        with thread_lock:
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+            except OSError:
+                log.debug("Waiting for another process to fetch {}".format(key))
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, slot)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, slot)
+
+
+_key_locks = {}
+_key_locks_mutex = threading.Lock()
+
+
+def _get_key_locks(path):
+    with _key_locks_mutex:
+        if path not in _key_locks:
+            _key_locks[path] = _KeyLocks(path)
+        return _key_locks[path]
+
+
+# Generation counter kept in the lock file of a GdbmCache.
+_GENERATION = struct.Struct('!Q')
+
+
+class GdbmCache(Cache):
+    '''Cache implementation which uses the GNU DBM library.'''
+
+    # GDBM does not support concurrent writers & readers. Rather than
+    # re-opening the database for every read and write, we keep a single
+    # handle open and coordinate with other processes using flock() on a
+    # separate lock file: readers take a shared lock and writers take an
+    # exclusive lock. GDBM's own locking is disabled as it would prevent
+    # several processes from keeping the database open at once.
+    #
+    # GDBM keeps parts of the database in memory, so once another process
+    # has written to the file our handle may be out of date. Every write
+    # increments a generation counter stored in the lock file, and we reopen
+    # the database whenever we see that the counter has changed.
+
+    def __init__(self, namespace, cachedir=None):
+        if not HAVE_GDBM:
+            raise RuntimeError("The GDBM cache backend is not available. "
+                               "Please install the Python GDBM bindings.")
+
+        super(GdbmCache, self).__init__()
+
+        if cachedir is None:
+            cachedir = xdg.BaseDirectory.save_cache_path('calliope')
+
+        self._path = os.path.join(cachedir, namespace) + '.gdbm'
+        self._lock_path = self._path + '.lock'
+        self._key_locks_path = self._path + '.keylock'
+
+        self._db = None
+        self._db_writable = False
+        self._generation = None
+
+        self._lock_fd = None
+        # flock() locks are held per open file, so threads that share this
+        # object need to be serialized separately.
+        self._mutex = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        with self._mutex:
+            if self._lock_fd is None:
+                self._lock_fd = os.open(self._lock_path,
+                                        os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._lock_fd, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _read_generation(self):
+        data = os.pread(self._lock_fd, _GENERATION.size, 0)
+        if len(data) < _GENERATION.size:
+            return 0
+        return _GENERATION.unpack(data)[0]
+
+    def _write_generation(self, generation):
+        os.pwrite(self._lock_fd, _GENERATION.pack(generation), 0)
+        self._generation = generation
+
+    def _close_db(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _get_db(self, writable=False):
+        # Return the open database handle, reopening it if another process
+        # has written to the database since we last used it. Must be called
+        # with the lock held. Returns None if the database doesn't exist yet
+        # and we only want to read it.
+        generation = self._read_generation()
+        if self._db is not None and generation == self._generation:
+            if self._db_writable or not writable:
+                return self._db
+
+        self._close_db()
+        if writable:
+            self._db = dbm.gnu.open(self._path, 'cu')
+        elif os.path.exists(self._path):
+            self._db = dbm.gnu.open(self._path, 'ru')
+        else:
+            return None
+        self._db_writable = writable
+        self._generation = generation
+        return self._db
+
+    def _read(self, keys):
+        result = {}
+        with self._locked(fcntl.LOCK_SH):
+            db = self._get_db()
+            if db is None:
+                return result
+            for key in keys:
+                try:
+                    result[key] = db[key]
+                except KeyError:
+                    pass
+        return result
+
+    def _write(self, entries):
+        if not entries:
+            return
+        with self._locked(fcntl.LOCK_EX):
+            db = self._get_db(writable=True)
+            for key, data in entries.items():
+                db[key] = data
+            self._write_generation(self._generation + 1)
+
+    def _keys(self):
+        with self._locked(fcntl.LOCK_SH):
+            db = self._get_db()
+            if db is None:
+                return []
+            return [key.decode('utf-8') for key in db.keys()]
+
+    def _delete(self, keys):
+        if not keys:
+            return
+        with self._locked(fcntl.LOCK_EX):
+            db = self._get_db(writable=True)
+            for key in keys:
+                try:
+                    del db[key]
+                except KeyError:
+                    pass
+            self._write_generation(self._generation + 1)
+
+    def compact(self):
+        # GDBM reuses the space freed by deleted entries, but never gives it
+        # back to the filesystem unless asked.
+        with self._locked(fcntl.LOCK_EX):
+            db = self._get_db(writable=True)
+            db.reorganize()
+            self._write_generation(self._generation + 1)
+
+    def size_on_disk(self):
+        try:
+            return os.path.getsize(self._path)
+        except FileNotFoundError:
+            return 0
+
+    def close(self):
+        super(GdbmCache, self).close()
+        with self._mutex:
+            self._close_db()
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+
+class SqliteCache(Cache):
+    '''Cache implementation which uses SQLite.'''
+
+    # The database is used in write-ahead log mode, so any number of
+    # processes can read from the cache while another process writes to it.
+    #
+    # Committing a transaction is expensive and holds the write lock, so we
+    # don't commit every store() individually. Stored values are kept in
+    # memory and written out in a single transaction once 'batch_size'
+    # values are pending, or the oldest pending value is more than
+    # 'batch_delay' seconds old. Pending values are also written when the
+    # cache is closed, garbage collected, or the process exits.
+
+    def __init__(self, namespace, cachedir=None, batch_size=100,
+                 batch_delay=5.0):
+        super(SqliteCache, self).__init__()
+
+        if cachedir is None:
+            cachedir = xdg.BaseDirectory.save_cache_path('calliope')
+
+        self._path = os.path.join(cachedir, namespace) + '.cache.sqlite'
+        self._key_locks_path = self._path + '.keylock'
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+
+        self._db = sqlite3.connect(self._path, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         '   key TEXT PRIMARY KEY, '
+                         '   value BLOB NOT NULL '
+                         ')')
+
+        self._pending = {}
+        self._pending_since = None
+        self._mutex = threading.Lock()
+
+        self._finalizer = weakref.finalize(
+            self, SqliteCache._commit, self._db, self._pending, self._mutex)
+
+    @staticmethod
+    def _commit(db, pending, mutex):
+        # This is a static method so that the finalizer doesn't keep the
+        # cache object alive.
+        with mutex:
+            if not pending:
+                return
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.executemany('INSERT OR REPLACE INTO cache(key, value) '
+                               '  VALUES (?, ?)', pending.items())
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+            log.debug("Committed %i values to cache", len(pending))
+            pending.clear()
+
+    # SQLite limits the number of parameters in a single statement.
+    MAX_QUERY_KEYS = 500
+
+    def _read(self, keys):
+        result = {}
+        with self._mutex:
+            missing = []
+            for key in keys:
+                if key in self._pending:
+                    result[key] = self._pending[key]
+                else:
+                    missing.append(key)
+
+            for i in range(0, len(missing), self.MAX_QUERY_KEYS):
+                chunk = missing[i:i+self.MAX_QUERY_KEYS]
+                sql = 'SELECT key, value FROM cache WHERE key IN ({})'.format(
+                    ', '.join('?' * len(chunk)))
+                result.update(self._db.execute(sql, chunk))
+        return result
+
+    def _write(self, entries):
+        with self._mutex:
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.update(entries)
+            due = (len(self._pending) >= self._batch_size or
+                   time.monotonic() - self._pending_since >= self._batch_delay)
+        if due:
+            self.flush()
+
+    def _keys(self):
+        self.flush()
+        with self._mutex:
+            return [row[0] for row in self._db.execute('SELECT key FROM cache')]
+
+    def _delete(self, keys):
+        self.flush()
+        with self._mutex:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                for i in range(0, len(keys), self.MAX_QUERY_KEYS):
+                    chunk = keys[i:i+self.MAX_QUERY_KEYS]
+                    sql = 'DELETE FROM cache WHERE key IN ({})'.format(
+                        ', '.join('?' * len(chunk)))
+                    self._db.execute(sql, chunk)
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def compact(self):
+        self.flush()
+        with self._mutex:
+            self._db.execute('VACUUM')
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def size_on_disk(self):
+        size = 0
+        for path in [self._path, self._path + '-wal']:
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return size
+
+    def flush(self):
+        '''Write any pending values to the database.'''
+        self._commit(self._db, self._pending, self._mutex)
+
+    def close(self):
+        super(SqliteCache, self).close()
+        self._finalizer()
+        self._db.close()
+
+
+class MemoryCache(Cache):
+    '''Keeps recently used values in memory, in front of another cache.
+
+    Values are kept already decoded, so repeated lookups of the same key cost
+    no more than a dict lookup. Once the total size of the values held goes
+    over 'max_size' bytes, the least recently used values are discarded. The
+    size of a value is measured as the size of its encoded form.
+
+    The 'hits' and 'misses' attributes count how many lookups were answered
+    from memory and how many had to go to the 'backend' cache.
+
+    Values returned from the cache are shared with later lookups, so they must
+    not be modified.
+
+    '''
+    def __init__(self, backend, max_size):
+        super(MemoryCache, self).__init__()
+
+        self.backend = backend
+        self.max_size = max_size
+
+        self._key_locks_path = backend._key_locks_path
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._mutex = threading.Lock()
+
+    def _remember(self, key, entry, size):
+        # Must be called with the mutex held.
+        if key in self._entries:
+            self._size -= self._entries.pop(key)[1]
+        if size > self.max_size:
+            return
+        self._entries[key] = (entry, size)
+        self._size += size
+        while self._size > self.max_size:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._size -= evicted_size
+
+    def _lookup_entries(self, keys):
+        result = {}
+        missing = []
+        with self._mutex:
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    result[key] = self._entries[key][0]
+                    self.hits += 1
+                else:
+                    missing.append(key)
+                    self.misses += 1
+
+        if missing:
+            found = self.backend._read(missing)
+            with self._mutex:
+                for key, data in found.items():
+                    entry = self.backend._decode_entry(key, data)
+                    self._remember(key, entry, len(key) + len(data))
+                    result[key] = entry
+        return result
+
+    def _reread_entries(self, keys):
+        result = {}
+        found = self.backend._read(keys)
+        with self._mutex:
+            for key, data in found.items():
+                entry = self.backend._decode_entry(key, data)
+                self._remember(key, entry, len(key) + len(data))
+                result[key] = entry
+        return result
+
+    def store_many(self, values):
+        stored_at = time.time()
+        encoded = self.backend._encode_many(values, stored_at)
+        self.backend._write(encoded)
+        with self._mutex:
+            for key, value in values.items():
+                self._remember(key, Entry(value, stored_at),
+                               len(key) + len(encoded[key]))
+
+    def _forget(self, keys):
+        with self._mutex:
+            for key in keys:
+                if key in self._entries:
+                    self._size -= self._entries.pop(key)[1]
+
+    def _read(self, keys):
+        return self.backend._read(keys)
+
+    def _write(self, entries):
+        self._forget(entries.keys())
+        self.backend._write(entries)
+
+    def _keys(self):
+        return self.backend._keys()
+
+    def _delete(self, keys):
+        self._forget(keys)
+        self.backend._delete(keys)
+
+    def _encode_many(self, values, stored_at):
+        return self.backend._encode_many(values, stored_at)
+
+    def _decode_entry(self, key, data):
+        return self.backend._decode_entry(key, data)
+
+    def compact(self):
+        self.backend.compact()
+
+    def size_on_disk(self):
+        return self.backend.size_on_disk()
+
+    def flush(self):
+        self.backend.flush()
+
+    def close(self):
+        super(MemoryCache, self).close()
+        log.debug("Memory cache: %i hits, %i misses", self.hits, self.misses)
+        self.backend.close()
+
+
+BACKENDS = {
+    'gdbm': GdbmCache,
+    'sqlite': SqliteCache,
+}
+
+
+# Default limit for the size of values kept in memory, in bytes.
+DEFAULT_MEMORY_SIZE = 64 * 1024 * 1024
+
+
+# File name suffix used by each backend.
+SUFFIXES = {
+    'gdbm': '.gdbm',
+    'sqlite': '.cache.sqlite',
+}
+
+
+def list_namespaces(cachedir=None):
+    '''List the caches that exist on disk.
+
+    Returns a list of (namespace, backend) tuples.
+
+    '''
+    if cachedir is None:
+        cachedir = xdg.BaseDirectory.save_cache_path('calliope')
+
+    result = []
+    for filename in sorted(os.listdir(cachedir)):
+        for backend, suffix in SUFFIXES.items():
+            if filename.endswith(suffix):
+                result.append((filename[:-len(suffix)], backend))
+    return result
+
+
+def _get_option(namespace, option):
+    # Options can be set for every cache in the [cache] section of the
+    # configuration file, or for one namespace in a [cache:NAMESPACE] section.
+    value = calliope.config.get('cache:' + namespace, option)
+    if value is None:
+        value = calliope.config.get('cache', option)
+    return value
+
+
+def _parse_boolean(value):
+    if isinstance(value, str):
+        return value.lower() in ['1', 'yes', 'true', 'on']
+    return bool(value)
+
+
+def open(namespace, cachedir=None, backend=None, memory_size=None, ttl=None,
+         negative_ttl=None, stale_while_revalidate=None, single_flight=None,
+         compress=None):
     '''Open a cache using the best available cache implementation.
 
     The 'namespace' parameter should usually correspond with the name of tool
@@ -158,5 +1284,75 @@ def open(namespace, cachedir=None):
 
     The 'cachedir' parameter is mainly for use during automated tests.
 
+    The other parameters default to the option of the same name in the
+    configuration file, which can be set in a `[cache:NAMESPACE]` section for
+    one namespace or in the `[cache]` section for all of them.
+
+    The 'backend' parameter selects a specific implementation, either 'gdbm'
+    or 'sqlite'. If it isn't configured, GDBM is used if available and SQLite
+    otherwise.
+
+    Recently used values are also kept in memory, up to 'memory_size' bytes.
+    This defaults to DEFAULT_MEMORY_SIZE. Passing 0 disables the memory cache.
+
+    The 'ttl' parameter sets how many seconds entries stay valid for, and
+    'stale_while_revalidate' controls whether expired entries are refreshed
+    in the background. See `Cache.wrap()`. By default, entries never expire.
+
+    The 'negative_ttl' parameter sets how many seconds negative entries stay
+    valid for, and defaults to DEFAULT_NEGATIVE_TTL. Set it to 'none' in the
+    configuration file to use 'ttl' for negative entries too. See
+    `Cache.store_negative()`.
+
+    The 'single_flight' parameter stops several processes from running the
+    same remote query at once. See `Cache.wrap()`.
+
+    If 'compress' is set, new entries are stored compressed. Compressed
+    entries can always be read back, whatever this is set to.
+
     '''
-    return GdbmCache(namespace, cachedir=cachedir)
+    if backend is None:
+        backend = _get_option(namespace, 'backend')
+    if backend is None:
+        backend = 'gdbm' if HAVE_GDBM else 'sqlite'
+
+    if backend not in BACKENDS:
+        raise RuntimeError("Unknown cache backend '{}'. Valid backends are: "
+                           "{}".format(backend, ', '.join(sorted(BACKENDS))))
+    cache = BACKENDS[backend](namespace, cachedir=cachedir)
+
+    if compress is None:
+        compress = _get_option(namespace, 'compress')
+    cache.compress = _parse_boolean(compress)
+
+    if memory_size is None:
+        memory_size = _get_option(namespace, 'memory-size')
+    if memory_size is None:
+        memory_size = DEFAULT_MEMORY_SIZE
+    memory_size = int(memory_size)
+
+    if memory_size > 0:
+        cache = MemoryCache(cache, max_size=memory_size)
+
+    if ttl is None:
+        ttl = _get_option(namespace, 'ttl')
+    if ttl is not None:
+        cache.ttl = float(ttl)
+
+    if negative_ttl is None:
+        negative_ttl = _get_option(namespace, 'negative-ttl')
+    if negative_ttl is not None:
+        if str(negative_ttl).lower() == 'none':
+            cache.negative_ttl = None
+        else:
+            cache.negative_ttl = float(negative_ttl)
+
+    if stale_while_revalidate is None:
+        stale_while_revalidate = _get_option(namespace, 'stale-while-revalidate')
+    cache.stale_while_revalidate = _parse_boolean(stale_while_revalidate)
+
+    if single_flight is None:
+        single_flight = _get_option(namespace, 'single-flight')
+    cache.single_flight = _parse_boolean(single_flight)
+
+    return cache
@@ -27,6 +27,7 @@ import xdg.BaseDirectory
 import logging
 import os
 import sys
+import time
 
 import calliope
 
@@ -42,12 +43,25 @@ import calliope
 
 
 class App:
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, format='json', compress=None, workers=1):
         self.debug = debug
+        self.format = format
+        self.compress = compress
+        self.workers = workers
 
 
 @click.group()
 @click.option('-d', '--debug', is_flag=True)
+@click.option('--format', type=click.Choice(['json', 'binary']), default='json',
+              help="format of playlists that are output. The format of input "
+                   "playlists is detected automatically. (Default: 'json')")
+@click.option('--compress', type=click.Choice(['gzip', 'zstd']),
+              help="compress playlists that are output. Compressed input "
+                   "playlists are detected automatically.")
+@click.option('--workers', type=int, default=1, metavar='N',
+              help="number of processes to use when parsing large input "
+                   "playlists in the `diff`, `export`, `select` and `stat` "
+                   "commands. (Default: 1)")
 @click.pass_context
 def cli(context, **kwargs):
     '''Calliope is a set of tools for processing playlists.'''
@@ -58,44 +72,198 @@ def cli(context, **kwargs):
         logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 
 
+def _write_playlist(context, items):
+    # Write to stdout in the format chosen with the global options.
+    calliope.playlist.write(items, sys.stdout, context.obj.format,
+                            context.obj.compress)
+
+
+def _open_caches(namespaces):
+    # Open the named caches, or every cache that exists if none are named.
+    found = dict(calliope.cache.list_namespaces())
+    if not namespaces:
+        namespaces = sorted(found)
+    for namespace in namespaces:
+        if namespace not in found:
+            raise RuntimeError("No cache found for namespace '{}'".format(namespace))
+        yield namespace, calliope.cache.open(namespace, backend=found[namespace],
+                                             memory_size=0)
+
+
+@cli.group(name='cache', help="Inspect and maintain the local caches")
+@click.pass_context
+def cache_cli(context):
+    pass
+
+
+@cache_cli.command(name='stats')
+@click.option('--namespace', '-n', multiple=True,
+              help="show only the given cache (default: all caches)")
+@click.pass_context
+def cmd_cache_stats(context, namespace):
+    '''Show the size and contents of each cache'''
+    for name, cache in _open_caches(namespace):
+        stats = cache.stats()
+        print("{}: {} entries, {} bytes, {} bytes on disk".format(
+            name, stats['entries'], stats['bytes'], stats['size_on_disk']))
+        if stats['lookups'] > 0:
+            print("  hit ratio: {:.1%} of {} lookups".format(
+                stats['hits'] / stats['lookups'], stats['lookups']))
+        for prefix, (entries, size) in sorted(stats['prefixes'].items()):
+            print("  {}: {} entries, {} bytes".format(prefix, entries, size))
+        cache.close()
+
+
+@cache_cli.command(name='compact')
+@click.option('--namespace', '-n', multiple=True,
+              help="compact only the given cache (default: all caches)")
+@click.pass_context
+def cmd_cache_compact(context, namespace):
+    '''Reclaim unused space in the cache files'''
+    for name, cache in _open_caches(namespace):
+        size_before = cache.size_on_disk()
+        cache.compact()
+        print("{}: {} bytes -> {} bytes".format(name, size_before,
+                                               cache.size_on_disk()))
+        cache.close()
+
+
+@cache_cli.command(name='prune')
+@click.option('--namespace', '-n', multiple=True,
+              help="prune only the given cache (default: all caches)")
+@click.option('--prefix', metavar='TEXT',
+              help="remove entries whose keys begin with TEXT")
+@click.option('--older-than', metavar='DAYS', type=float,
+              help="remove entries stored more than DAYS days ago")
+@click.pass_context
+def cmd_cache_prune(context, namespace, prefix, older_than):
+    '''Remove entries from the caches'''
+    if prefix is None and older_than is None:
+        raise RuntimeError("Please specify --prefix and/or --older-than.")
+
+    stored_before = None
+    if older_than is not None:
+        stored_before = time.time() - older_than * 24 * 60 * 60
+
+    for name, cache in _open_caches(namespace):
+        count = cache.prune(prefix=prefix, stored_before=stored_before)
+        print("{}: removed {} entries".format(name, count))
+        cache.close()
+
+
+@cache_cli.command(name='export')
+@click.option('--namespace', '-n', required=True,
+              help="cache to export")
+@click.argument('output', type=click.File(mode='w'), default='-')
+@click.pass_context
+def cmd_cache_export(context, namespace, output):
+    '''Write the contents of a cache as JSON'''
+    for name, cache in _open_caches([namespace]):
+        cache.export(output)
+        cache.close()
+
+
+@cache_cli.command(name='warm')
+@click.option('--namespace', '-n', required=True,
+              type=click.Choice(['lastfm', 'musicbrainz']),
+              help="cache to fill")
+@click.option('--include', '-i', type=click.Choice(['urls']), multiple=True,
+              help="extra MusicBrainz information to fetch")
+@click.option('--jobs', '-j', type=int, default=4,
+              help="number of remote queries to run at once")
+@click.argument('playlist', type=click.File(mode='r'))
+@click.pass_context
+def cmd_cache_warm(context, namespace, include, jobs, playlist):
+    '''Fetch the data needed to annotate a playlist ahead of time'''
+    items = calliope.playlist.read(playlist)
+    if namespace == 'lastfm':
+        lastfm = calliope.lastfm.LastfmContext()
+        lastfm.authenticate()
+        count = calliope.lastfm.warm_tags(lastfm, items, jobs)
+        lastfm.cache.close()
+    else:
+        count = calliope.musicbrainz.warm(items, include, jobs)
+    print("{}: fetched {} entries".format(namespace, count))
+
+
+@cache_cli.command(name='import')
+@click.option('--namespace', '-n', required=True,
+              help="cache to import into")
+@click.argument('input', type=click.File(mode='r'))
+@click.pass_context
+def cmd_cache_import(context, namespace, input):
+    '''Load entries written by `cache export` into a cache'''
+    cache = calliope.cache.open(namespace, memory_size=0)
+    count = cache.import_(input)
+    cache.close()
+    print("{}: imported {} entries".format(namespace, count))
+
+
 @cli.command(name='diff', help="Compare multiple collections")
 @click.argument('playlist1', type=click.File(mode='r'))
 @click.argument('playlist2', type=click.File(mode='r'))
 @click.pass_context
 def cmd_diff(context, playlist1, playlist2):
-    result = calliope.diff.diff(calliope.playlist.read(playlist1),
-                                calliope.playlist.read(playlist2))
-    calliope.playlist.write(result, sys.stdout)
+    workers = context.obj.workers
+    result = calliope.diff.diff(calliope.playlist.read(playlist1, workers),
+                                calliope.playlist.read(playlist2, workers))
+    _write_playlist(context, result)
 
 
 @cli.command(name='export')
-@click.option('-f', '--format', type=click.Choice(['cue', 'm3u', 'jspf', 'xspf']), default='m3u')
+@click.option('-f', '--format', default='m3u',
+              type=click.Choice(['cue', 'm3u', 'jspf', 'xspf', 'parquet', 'arrow']))
+@click.option('-o', '--output', type=click.File('wb'), default='-',
+              help="file to write to (default: stdout)")
 @click.argument('playlist', nargs=1, type=click.File('r'))
 @click.pass_context
-def cmd_export(context, format, playlist):
+def cmd_export(context, format, output, playlist):
     '''Convert to a different playlist format'''
 
-    if format == 'cue':
-        print(calliope.export.convert_to_cue(calliope.playlist.read(playlist)))
+    playlist = calliope.playlist.read(playlist, context.obj.workers)
+
+    if format == 'parquet':
+        calliope.export.write_parquet(playlist, output)
+        return
+    elif format == 'arrow':
+        calliope.export.write_arrow(playlist, output)
+        return
+    elif format == 'cue':
+        text = calliope.export.convert_to_cue(playlist)
     elif format == 'm3u':
-        print(calliope.export.convert_to_m3u(calliope.playlist.read(playlist)))
+        text = calliope.export.convert_to_m3u(playlist)
     elif format == 'jspf':
-        print(calliope.export.convert_to_jspf(calliope.playlist.read(playlist)))
+        text = calliope.export.convert_to_jspf(playlist)
     elif format == 'xspf':
-        print(calliope.export.convert_to_xspf(calliope.playlist.read(playlist)))
+        text = calliope.export.convert_to_xspf(playlist)
     else:
         raise NotImplementedError("Unsupport format: %s" % format)
+    output.write((text + '\n').encode('utf-8'))
 
 
 @cli.command(name='import')
-@click.argument('playlist', nargs=1, type=click.File('r'))
+@click.argument('playlist', nargs=1, type=click.File('rb'))
 @click.pass_context
 def cmd_import(context, playlist):
     '''Import playlists from other formats'''
 
-    text = playlist.read()
-    playlist = calliope.import_.import_(text)
-    calliope.playlist.write(playlist, sys.stdout)
+    data = playlist.read()
+    playlist = calliope.import_.import_(data)
+    _write_playlist(context, playlist)
+
+
+@cli.command(name='index')
+@click.option('--ids', is_flag=True,
+              help="also index the item IDs, for lookups by ID")
+@click.argument('playlist', type=click.Path(exists=True, dir_okay=False))
+@click.pass_context
+def cmd_index(context, ids, playlist):
+    '''Create an index file for random access to a playlist.
+
+    The index is written to PLAYLIST.index. Some commands use it to avoid
+    reading the whole playlist, for example `shuffle --count`.'''
+    with calliope.playlist.IndexedPlaylist(playlist, index_ids=ids) as indexed:
+        print("Indexed {} items".format(len(indexed)))
 
 
 @cli.group(name='lastfm', help="Interface to the Last.fm music database")
@@ -115,7 +283,7 @@ def lastfm_annotate_tags(context, playlist):
     context.obj.lastfm.authenticate()
     result_generator = calliope.lastfm.annotate_tags(
         context.obj.lastfm, calliope.playlist.read(playlist))
-    calliope.playlist.write(result_generator, sys.stdout)
+    _write_playlist(context, result_generator)
 
 
 @lastfm_cli.command(name='similar-artists')
@@ -128,7 +296,7 @@ def cmd_lastfm_similar_artists(context, count, artist):
 
     output = calliope.lastfm.similar_artists(context.obj.lastfm, count,
                                              artist)
-    calliope.playlist.write(output, sys.stdout)
+    _write_playlist(context, output)
 
 
 @lastfm_cli.command(name='similar-tracks')
@@ -142,7 +310,7 @@ def cmd_lastfm_similar_artists(context, count, artist, track):
 
     output = calliope.lastfm.similar_tracks(context.obj.lastfm, count,
                                             artist, track)
-    calliope.playlist.write(output, sys.stdout)
+    _write_playlist(context, output)
 
 
 @lastfm_cli.command(name='top-artists')
@@ -159,7 +327,7 @@ def cmd_lastfm_top_artists(context, count, time_range, include):
     context.obj.lastfm.authenticate()
     result = calliope.lastfm.top_artists(context.obj.lastfm, count, time_range,
                                          include)
-    calliope.playlist.write(output, sys.stdout)
+    _write_playlist(context, output)
 
 
 @cli.group(name='lastfm-history',
@@ -185,7 +353,7 @@ def lastfm_history_cli(context, sync, user):
 def cmd_lastfm_history_scrobbles(context):
     lastfm_history = context.obj.lastfm_history
     tracks = lastfm_history.scrobbles()
-    calliope.playlist.write(tracks, sys.stdout)
+    _write_playlist(context, tracks)
 
 
 @lastfm_history_cli.command(name='artists',
@@ -222,7 +390,7 @@ def cmd_lastfm_history_artists(context, first_play_before, first_play_since,
         last_play_before=last_play_before,
         last_play_since=last_play_since,
         min_listens=min_listens)
-    calliope.playlist.write(artists, sys.stdout)
+    _write_playlist(context, artists)
 
 @lastfm_history_cli.command(name='tracks',
                             help="Query tracks from the listening history")
@@ -258,7 +426,7 @@ def cmd_lastfm_history_tracks(context, first_play_before, first_play_since,
         last_play_before=last_play_before,
         last_play_since=last_play_since,
         min_listens=min_listens)
-    calliope.playlist.write(tracks, sys.stdout)
+    _write_playlist(context, tracks)
 
 
 @cli.command(name='musicbrainz')
@@ -270,7 +438,7 @@ def cmd_musicbrainz(context, playlist, include):
 
     result_generator = calliope.musicbrainz.annotate(
         calliope.playlist.read(playlist), include)
-    calliope.playlist.write(result_generator, sys.stdout)
+    _write_playlist(context, result_generator)
 
 
 @cli.command(name='play')
@@ -283,7 +451,32 @@ def cmd_play(context, output, playlist):
     output_playlist = calliope.play.play(calliope.playlist.read(playlist),
                                          output)
     if output_playlist is not None:
-        calliope.playlist.write(output_playlist, sys.stdout)
+        _write_playlist(context, output_playlist)
+
+
+@cli.command(name='select')
+@click.option('--key', '-k', 'keys', multiple=True, metavar='KEY',
+              help="keep only this property in each item. Can be given more "
+                   "than once.")
+@click.option('--where', '-w', multiple=True, metavar='CONDITION',
+              help="output only items that match CONDITION, for example "
+                   "'artist=Björk', 'lastfm.playcount>=10' or 'track~^Intro'. "
+                   "Can be given more than once.")
+@click.argument('playlist', type=click.File(mode='r'))
+@click.pass_context
+def cmd_select(context, keys, where, playlist):
+    '''Select items and properties from a playlist.'''
+
+    predicates = [calliope.select.parse_predicate(text) for text in where]
+
+    # Properties that aren't needed are dropped as the input is read.
+    read_keys = None
+    if keys:
+        read_keys = set(keys).union(predicate.key for predicate in predicates)
+
+    items = calliope.playlist.read(playlist, context.obj.workers, read_keys)
+    output = calliope.select.select(items, keys, predicates)
+    _write_playlist(context, output)
 
 
 @cli.command(name='shuffle')
@@ -294,8 +487,15 @@ def cmd_play(context, output, playlist):
 def cmd_shuffle(context, count, playlist):
     '''Shuffle a playlist or collection.'''
 
-    output = calliope.shuffle.shuffle(calliope.playlist.read(playlist), count)
-    calliope.playlist.write(output, sys.stdout)
+    if os.path.exists(playlist.name + '.index'):
+        # The playlist was indexed with `cpe index`, so we can pick items
+        # from it without reading the whole file.
+        with calliope.playlist.IndexedPlaylist(playlist.name) as indexed:
+            output = calliope.shuffle.shuffle_indexed(indexed, count)
+            _write_playlist(context, output)
+    else:
+        output = calliope.shuffle.shuffle(calliope.playlist.read(playlist), count)
+        _write_playlist(context, output)
 
 
 @cli.group(name='spotify',
@@ -326,7 +526,7 @@ def cmd_spotify_annotate(context, playlist):
 
     for track in calliope.playlist.read(playlist):
         track = calliope.spotify.annotate_track(api, track)
-        calliope.playlist.write([track], sys.stdout)
+        _write_playlist(context, [track])
 
 
 @spotify_cli.command(name='export')
@@ -353,7 +553,7 @@ def cmd_spotify_top_artists(context, count, time_range):
     '''Return user's top artists.'''
     result = calliope.spotify.top_artists(context.obj.spotify, count, time_range)
 
-    calliope.playlist.write(result, sys.stdout)
+    _write_playlist(context, result)
 
 
 @cli.command(name='stat')
@@ -364,7 +564,7 @@ def cmd_spotify_top_artists(context, count, time_range):
 def cmd_stat(context, size, playlist):
     '''Information about the contents of a playlist'''
 
-    input_playlist = list(calliope.playlist.read(playlist))
+    input_playlist = list(calliope.playlist.read(playlist, context.obj.workers))
 
     if size:
         calliope.stat.measure_size(input_playlist)
@@ -451,7 +651,7 @@ def tracker_cli(context, domain, app_domain_dir):
 def cmd_tracker_annotate(context, playlist):
     '''Add information stored in a Tracker database to items in a playlist.'''
     output = calliope.tracker.annotate(context.obj.tracker, calliope.playlist.read(playlist))
-    calliope.playlist.write(output, sys.stdout)
+    _write_playlist(context, output)
 
 
 @tracker_cli.command(name='expand-tracks')
@@ -460,7 +660,7 @@ def cmd_tracker_annotate(context, playlist):
 def cmd_tracker_expand_tracks(context, playlist):
     '''Convert any 'artist' or 'album' type playlist items into 'track' items'''
     result = calliope.tracker.expand_tracks(context.obj.tracker.client, calliope.playlist.read(playlist))
-    calliope.playlist.write(result, sys.stdout)
+    _write_playlist(context, result)
 
 
 @tracker_cli.command(name='local-albums')
@@ -470,7 +670,7 @@ def cmd_tracker_expand_tracks(context, playlist):
 def cmd_tracker_local_albums(context, artist):
     '''Show all albums available locally..'''
     tracker = context.obj.tracker.client
-    calliope.playlist.write(tracker.albums(filter_artist_name=artist), sys.stdout)
+    _write_playlist(context, tracker.albums(filter_artist_name=artist))
 
 
 @tracker_cli.command(name='local-artists')
@@ -478,7 +678,7 @@ def cmd_tracker_local_albums(context, artist):
 def cmd_tracker_local_artists(context):
     '''Show all artists whose music is available locally..'''
     tracker = context.obj.tracker.client
-    calliope.playlist.write(tracker.artists(), sys.stdout)
+    _write_playlist(context, tracker.artists())
 
 
 @tracker_cli.command(name='local-tracks')
@@ -486,7 +686,7 @@ def cmd_tracker_local_artists(context):
 def cmd_tracker_local_tracks(context):
     '''Show all tracks available locally..'''
     tracker = context.obj.tracker.client
-    calliope.playlist.write(tracker.tracks(), sys.stdout)
+    _write_playlist(context, tracker.tracks())
 
 
 @tracker_cli.command(name='scan')
@@ -505,7 +705,7 @@ def cmd_tracker_scan(context, path):
 def cmd_tracker_search(context, text):
     '''Search track titles in the Tracker database.'''
     tracker = context.obj.tracker.client
-    calliope.playlist.write(tracker.tracks(track_search_text=text), sys.stdout)
+    _write_playlist(context, tracker.tracks(track_search_text=text))
 
 
 @tracker_cli.command(name='sparql')
@@ -524,7 +724,7 @@ def cmd_tracker_top_artists(context, count):
     '''Query the top artists in a Tracker database'''
     tracker = context.obj.tracker_client
     result = list(tracker.artists_by_number_of_songs(limit=count))
-    calliope.playlist.write(result, sys.stdout)
+    _write_playlist(context, result)
 
 
 @cli.command(name='web')
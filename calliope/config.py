@@ -35,6 +35,6 @@ def get(section, option):
     if __configuration == None:
         __configuration = Configuration()
     if __configuration.has_section(section):
-        return __configuration.get(section, option)
+        return __configuration.get(section, option, fallback=None)
     else:
         return None
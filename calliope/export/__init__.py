@@ -22,6 +22,17 @@ import json
 import xml.dom.minidom
 import xml.etree.ElementTree
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Columns whose values don't share a single Arrow type are stored as JSON
+# text. The list of these columns is kept in the table's schema metadata.
+ARROW_JSON_COLUMNS_KEY = b'calliope.json-columns'
+
 
 def convert_to_cue(playlist):
     output_text = ['FILE "none" WAVE']
@@ -153,3 +164,49 @@ def convert_to_xspf(playlist):
     text = xml.etree.ElementTree.tostring(root, 'utf-8')
     dom = xml.dom.minidom.parseString(text)
     return dom.toprettyxml(indent='\t')
+
+
+def convert_to_arrow_table(playlist):
+    '''Convert a playlist to a pyarrow.Table.
+
+    Each property becomes a column, and items that don't have a property get
+    a null in that column. Column types are inferred from the values, for
+    example 'lastfm.playcount' becomes an integer column and 'lastfm.tags.top'
+    a list of strings. If the values of a property don't share a type, each
+    value is stored as JSON text.
+
+    '''
+    if pyarrow is None:
+        raise RuntimeError("The Parquet and Arrow formats require the 'pyarrow' "
+                           "Python module.")
+
+    items = list(playlist)
+    names = list(dict.fromkeys(key for item in items for key in item))
+
+    columns = []
+    json_columns = []
+    for name in names:
+        values = [item.get(name) for item in items]
+        try:
+            columns.append(pyarrow.array(values))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            columns.append(pyarrow.array(
+                [None if value is None else json.dumps(value) for value in values],
+                type=pyarrow.string()))
+            json_columns.append(name)
+
+    metadata = {ARROW_JSON_COLUMNS_KEY: json.dumps(json_columns)}
+    return pyarrow.Table.from_arrays(columns, names=names, metadata=metadata)
+
+
+def write_parquet(playlist, stream):
+    '''Write a playlist to a binary stream as a Parquet file.'''
+    table = convert_to_arrow_table(playlist)
+    pyarrow.parquet.write_table(table, stream)
+
+
+def write_arrow(playlist, stream):
+    '''Write a playlist to a binary stream as an Arrow IPC file.'''
+    table = convert_to_arrow_table(playlist)
+    with pyarrow.ipc.new_file(stream, table.schema) as writer:
+        writer.write_table(table)
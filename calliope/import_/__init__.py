@@ -25,12 +25,19 @@ import yaml
 
 import configparser
 import enum
+import json
 import logging
 import sys
 import xml.etree.ElementTree
 
 import calliope
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 log = logging.getLogger(__name__)
 
 
@@ -43,6 +50,10 @@ class PlaylistFormat(enum.Enum):
     XSPF = 2
     JSPF = 3
 
+    # https://parquet.apache.org/ and https://arrow.apache.org/
+    PARQUET = 4
+    ARROW = 5
+
 
 class PlaylistReadError(Exception):
     pass
@@ -237,7 +248,64 @@ def parse_jspf(text):
     return entries
 
 
+def guess_binary_format(data):
+    '''Identify binary playlist formats from the start of the data.'''
+    if data.startswith(b'PAR1'):
+        return PlaylistFormat.PARQUET
+    elif data.startswith(b'ARROW1'):
+        return PlaylistFormat.ARROW
+    return None
+
+
+def parse_arrow_table(table):
+    '''Convert a pyarrow.Table, such as calliope.export writes, to items.'''
+    metadata = table.schema.metadata or {}
+    json_columns = json.loads(
+        metadata.get(calliope.export.ARROW_JSON_COLUMNS_KEY, b'[]'))
+
+    entries = []
+    for row in table.to_pylist():
+        entry = {key: value for key, value in row.items() if value is not None}
+        for key in json_columns:
+            if key in entry:
+                entry[key] = json.loads(entry[key])
+        entries.append(calliope.playlist.Item(entry))
+    return entries
+
+
+def _require_pyarrow():
+    if pyarrow is None:
+        raise RuntimeError("The Parquet and Arrow formats require the 'pyarrow' "
+                           "Python module.")
+
+
+def parse_parquet(data):
+    _require_pyarrow()
+    return parse_arrow_table(
+        pyarrow.parquet.read_table(pyarrow.BufferReader(data)))
+
+
+def parse_arrow(data):
+    _require_pyarrow()
+    return parse_arrow_table(
+        pyarrow.ipc.open_file(pyarrow.BufferReader(data)).read_all())
+
+
 def import_(text):
+    '''Convert a playlist from another format.
+
+    The 'text' may be bytes, which is required for the binary Parquet and Arrow
+    formats.
+
+    '''
+    if isinstance(text, bytes):
+        playlist_format = guess_binary_format(text)
+        if playlist_format == PlaylistFormat.PARQUET:
+            return parse_parquet(text)
+        elif playlist_format == PlaylistFormat.ARROW:
+            return parse_arrow(text)
+        text = text.decode('utf-8')
+
     playlist_format = guess_format(text)
 
     if not playlist_format:
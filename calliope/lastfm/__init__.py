@@ -19,6 +19,7 @@ import lastfmclient
 
 import click
 
+import functools
 import hashlib
 import logging
 import os
@@ -58,14 +59,23 @@ class LastfmContext():
         redirect_uri = calliope.config.get('lastfm', 'redirect-uri')
 
         session_key_cache_id = sha1sum(client_id + client_secret + redirect_uri + self.user)
-        found, session_key = self.cache.lookup('key.%s' % session_key_cache_id)
-
-        if not found:
-            token = prompt_for_user_token(self.user, client_id, client_secret,
-                                          redirect_uri)
-
-            session_key = self.api.auth.get_session(token)
-            self.cache.store('key.%s' % session_key_cache_id, session_key)
+        # The session key is kept out of the cached data, so that it doesn't
+        # expire or get pruned.
+        name = 'session-key:%s' % session_key_cache_id
+        session_key = self.cache.get_persistent(name)
+
+        if session_key is None:
+            # Older versions of Calliope stored it as a cache entry.
+            legacy_key = 'key.%s' % session_key_cache_id
+            entry = self.cache.lookup_entry(legacy_key)
+            if entry is not None and entry.value is not None:
+                session_key = entry.value
+            else:
+                token = prompt_for_user_token(self.user, client_id, client_secret,
+                                              redirect_uri)
+                session_key = self.api.auth.get_session(token)
+            self.cache.set_persistent(name, session_key)
+            self.cache.delete_many([legacy_key])
 
         log.debug("LastFM session key: {}".format(session_key))
         self.api.session_key = session_key
@@ -148,35 +158,69 @@ def prompt_for_user_token(username, client_id=None, client_secret=None,
     return token
 
 
-def add_lastfm_artist_top_tags(lastfm, cache, item):
-    artist_name = item['artist']
-
-    cache_key = 'artist-top-tags:{}'.format(artist_name)
+def _get_artist_top_tags(lastfm, artist_name):
+    log.debug("Didn't find artist-top-tags:{} in cache, running remote query".format(artist_name))
     try:
-        entry = lastfm.cache.wrap(cache_key,
-                                  lambda: lastfm.api.artist.get_top_tags(artist_name))
+        return lastfm.api.artist.get_top_tags(artist_name)
     except lastfmclient.exceptions.InvalidParametersError:
+        return calliope.cache.NOT_FOUND
+
+
+def _set_artist_top_tags(item, entry):
+    if entry is calliope.cache.NOT_FOUND:
         warnings = item.get('lastfm.warnings', [])
         warnings += ["Unable to find artist on Last.fm"]
         item['lastfm.warnings'] = warnings
+    elif 'tag' in entry:
+        item['lastfm.tags.top'] = [tag['name'] for tag in entry['tag']]
+    return item
 
-        entry = None
-        cache.store(cache_key, None)
 
-    if entry is not None and 'tag' in entry:
-        item['lastfm.tags.top'] = [tag['name'] for tag in entry['tag']]
+def add_lastfm_artist_top_tags(lastfm, cache, item):
+    artist_name = item['artist']
 
-    return item
+    cache_key = 'artist-top-tags:{}'.format(artist_name)
+    entry = cache.wrap(cache_key,
+                       lambda: _get_artist_top_tags(lastfm, artist_name))
+    return _set_artist_top_tags(item, entry)
+
+
+def _annotate_tags_batch(lastfm, cache, items):
+    def get_artist_top_tags(item):
+        try:
+            return _get_artist_top_tags(lastfm, item['artist'])
+        except RuntimeError as e:
+            raise RuntimeError("%s\nItem: %s" % (e, item))
+
+    def needs_tags(item):
+        return 'artist' in item and 'last.fm.tags' not in item
+
+    calls = {'artist-top-tags:{}'.format(item['artist']): functools.partial(get_artist_top_tags, item)
+             for item in items if needs_tags(item)}
+    entries = cache.wrap_many(calls)
+    for item in items:
+        if needs_tags(item):
+            _set_artist_top_tags(item, entries['artist-top-tags:{}'.format(item['artist'])])
+    return items
 
 
 def annotate_tags(lastfm, playlist):
-    for item in playlist:
-        if 'artist' in item and 'last.fm.tags' not in item:
-            try:
-                item = add_lastfm_artist_top_tags(lastfm, lastfm.cache, item)
-            except RuntimeError as e:
-                raise RuntimeError("%s\nItem: %s" % (e, item))
-        yield item
+    yield from calliope.playlist.annotate_batches(
+        playlist, lastfm.cache,
+        functools.partial(_annotate_tags_batch, lastfm, lastfm.cache))
+
+
+def warm_tags(lastfm, playlist, max_workers=4):
+    '''Fetch the cache entries that annotate_tags() would need for 'playlist'.
+
+    Returns the number of entries that were fetched.
+
+    '''
+    artists = sorted({item['artist'] for item in playlist if 'artist' in item})
+    calls = {'artist-top-tags:{}'.format(artist):
+                functools.partial(_get_artist_top_tags, lastfm, artist)
+             for artist in artists}
+    return lastfm.cache.warm(calls, max_workers)
 
 
 def similar_artists(lastfm, count, artist_name):
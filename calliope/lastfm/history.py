@@ -31,6 +31,10 @@ import calliope.lastfm.lastexport
 log = logging.getLogger(__name__)
 
 
+# Number of pages of history that are fetched at once during sync.
+DEFAULT_SYNC_WORKERS = 4
+
+
 _escape_re = re.compile('[^a-zA-Z0-9]')
 def escape_for_sql_identifier(name):
     return re.sub(_escape_re, '_', name)
@@ -83,10 +87,6 @@ class _LastfmHistory:
     def migrations_dir(self):
         return os.path.join(os.path.dirname(__file__), 'migrations')
 
-    def _count_stored_plays(self, cursor):
-        stored_plays_sql = 'SELECT COUNT(id) FROM imports_lastfm'
-        return cursor.execute(stored_plays_sql).fetchone()[0]
-
     def _get_newest_play_datetime(self, cursor):
         newest_play_sql = \
             'SELECT datetime FROM imports_lastfm ORDER BY datetime DESC LIMIT 1'
@@ -96,6 +96,31 @@ class _LastfmHistory:
         else:
             return 0
 
+    def _get_sync_state(self, cursor):
+        sync_state_sql = 'SELECT time_from, time_to FROM sync_state_lastfm'
+        return cursor.execute(sync_state_sql).fetchone()
+
+    def _set_sync_state(self, cursor, time_from, time_to):
+        cursor.execute('INSERT OR REPLACE INTO sync_state_lastfm(id, time_from, '
+                       ' time_to) VALUES (1, ?, ?)', [time_from, time_to])
+
+    def _get_tracks(self, session, time_from, time_to):
+        workers = calliope.config.get('lastfm', 'sync-workers')
+        rate = calliope.config.get('lastfm', 'sync-requests-per-second')
+        return calliope.lastfm.lastexport.get_tracks(
+            'last.fm', self.username, tracktype='recenttracks',
+            workers=int(workers or DEFAULT_SYNC_WORKERS),
+            requests_per_second=float(
+                rate or calliope.lastfm.lastexport.DEFAULT_REQUESTS_PER_SECOND),
+            time_from=time_from or None, time_to=time_to, session=session)
+
+    def _open_session(self):
+        timeout = calliope.config.get('lastfm', 'sync-timeout')
+        retries = calliope.config.get('lastfm', 'sync-retries')
+        return calliope.lastfm.lastexport.Session(
+            timeout=float(timeout or calliope.lastfm.lastexport.DEFAULT_TIMEOUT),
+            retries=int(retries or calliope.lastfm.lastexport.DEFAULT_RETRIES))
+
     def sync(self, full=False):
         # FIXME: This currently won't take any notice if a track is *removed*
         # from the user's last.fm history. The 'full' sync mode needs to check
@@ -104,73 +129,59 @@ class _LastfmHistory:
 
         cursor = self.store.cursor()
 
-        stored_plays = self._count_stored_plays(cursor)
-        newest_play = self._get_newest_play_datetime(cursor)
-
-        log.debug("Newest play: %i", newest_play)
-
+        # One session is used for the whole sync, so connections are reused.
+        with self._open_session() as session:
+            state = self._get_sync_state(cursor)
+            if state is not None:
+                log.debug("Resuming interrupted sync of plays from %i to %i",
+                          state[0], state[1])
+                self._sync_window(session, *state)
+
+            # The newest stored play is fetched again, in case the API
+            # excludes plays at exactly 'time_from'. It is ignored when stored.
+            if full:
+                time_from = 0
+            else:
+                time_from = self._get_newest_play_datetime(cursor)
+            time_to = int(time.time())
+
+            log.debug("Syncing plays from %i to %i", time_from, time_to)
+            self._set_sync_state(cursor, time_from, time_to)
+            self.store.commit()
+            self._sync_window(session, time_from, time_to)
+
+    def _sync_window(self, session, time_from, time_to):
+        # Fetch and store the plays between 'time_from' and 'time_to'. The
+        # window is fixed, so the pages don't shift when new plays are
+        # scrobbled. Pages arrive newest first. After storing each page, we
+        # move the end of the window in the sync state back to the oldest
+        # play on that page, in the same transaction, so an interrupted sync
+        # can resume from exactly that point.
+        cursor = self.store.cursor()
         try:
-            gen = calliope.lastfm.lastexport.get_tracks(
-                'last.fm', self.username, tracktype='recenttracks')
-
-            page_size = None
-            total_pages = 0
-            for page, total_pages, tracks in gen:
-                if tracks is None:
-                    # This can happen when a fetch request times out.
-                    # The 'lastexport' will eventually raise an exception
-                    # after retrying a few times.
-                    continue
-
+            for page, total_pages, tracks in self._get_tracks(session, time_from, time_to):
                 log.debug("Received page %i/%i", page, total_pages)
-                top_datetime = int(tracks[0][0])
-
-                page_size = page_size or len(tracks)
-
-                if top_datetime <= newest_play:
-                    log.debug("Caught up with stored plays.")
-                    break
-
-                for scrobble in tracks:
-                    self.intern_scrobble(scrobble)
+                if tracks:
+                    self.intern_scrobbles(tracks)
+                    # Plays from the same second can span two pages, so
+                    # the oldest one is fetched again if we resume.
+                    oldest_play = min(int(track[0]) for track in tracks)
+                    self._set_sync_state(cursor, time_from, oldest_play + 1)
                 self.store.commit()
         except urllib.error.URLError as e:
             raise RuntimeError("Unable to sync lastfm history due to network "
                                "error: {}".format(e.args[0]))
 
-        last_stored_page = stored_plays / page_size
-        if last_stored_page < total_pages - 1:
-            log.debug('Processing missing history from page %i/%i',
-                      last_stored_page, total_pages)
-            gen = calliope.lastfm.lastexport.get_tracks(
-                'last.fm', self.username, tracktype='recenttracks',
-                startpage=last_stored_page)
-
-            for page, total_pages, tracks in gen:
-                log.debug("Received page %i/%i", page, total_pages)
-                for scrobble in tracks:
-                    self.intern_scrobble(scrobble)
-                self.store.commit()
-
-    def intern_scrobble(self, play_info):
-        datetime, trackname, artistname, albumname, trackmbid, artistmbid, \
-            albummbid = play_info
+        cursor.execute('DELETE FROM sync_state_lastfm')
+        self.store.commit()
 
+    def intern_scrobbles(self, plays):
+        '''Store many scrobbles at once, ignoring any that are already stored.'''
         cursor = self.store.cursor()
-        find_lastfm_sql = 'SELECT id FROM imports_lastfm ' \
-                          '  WHERE datetime = ? AND trackname = ? AND artistname = ?'
-        row = cursor.execute(find_lastfm_sql, [datetime, trackname, artistname]).fetchone()
-        if row is None:
-            cursor.execute(
-                'INSERT INTO imports_lastfm(datetime, trackname, '
-                ' artistname, albumname, trackmbid, artistmbid, '
-                ' albummbid) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                [datetime, trackname, artistname, albumname, trackmbid,
-                 artistmbid, albummbid])
-            scrobble_id = cursor.lastrowid
-        else:
-            scrobble_id = row[0]
-        return scrobble_id
+        cursor.executemany(
+            'INSERT OR IGNORE INTO imports_lastfm(datetime, trackname, '
+            ' artistname, albumname, trackmbid, artistmbid, '
+            ' albummbid) VALUES (?, ?, ?, ?, ?, ?, ?)', plays)
 
     def scrobbles(self):
         '''Return individual scrobbles as a Calliope playlist.'''
@@ -21,17 +21,39 @@ Script for exporting tracks through audioscrobbler API.
 Usage: lastexport.py -u USER [-o OUTFILE] [-p STARTPAGE] [-s SERVER]
 """
 
+import collections
+import concurrent.futures
+import gzip
+import http.client
 import logging
-import sys, time, re
+import random
+import sys, time
+import threading
+import urllib.error
 import urllib.parse
-import urllib.request
 import xml.etree.ElementTree as ET
+import zlib
 from optparse import OptionParser
 
 __version__ = '0.0.4'
 
 log = logging.getLogger(__name__)
 
+# The last.fm API terms allow 5 requests per second, averaged over 5 minutes.
+DEFAULT_REQUESTS_PER_SECOND = 4.0
+
+# Seconds to wait for the server to connect or respond.
+DEFAULT_TIMEOUT = 30
+
+# Failed requests are retried after about 1, 2, 4 ... seconds, up to a limit.
+DEFAULT_RETRIES = 4
+BACKOFF_INITIAL = 1
+BACKOFF_MAX = 60
+
+# Redirects are followed, up to a limit.
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
 def get_options(parser):
     """ Define command line options."""
     parser.add_option("-u", "--user", dest="username", default=None,
@@ -58,8 +80,143 @@ def get_options(parser):
          
     return options.username, options.outfile, options.startpage, options.server, infotype
 
-def connect_server(server, username, startpage, sleep_func=time.sleep, tracktype='recenttracks'):
-    """ Connect to server and get a XML page."""
+def backoff(attempt, error, sleep_func=time.sleep):
+    """Wait before retrying a request that has failed 'attempt' + 1 times."""
+    delay = min(BACKOFF_MAX, BACKOFF_INITIAL * 2 ** attempt)
+    delay = random.uniform(delay / 2, delay)
+    log.warning("Exception occured while fetching last.fm listen "
+                "history: %s. Retrying in %.1fs. Use --no-sync to disable "
+                "network access.", error, delay)
+    sleep_func(delay)
+
+class Session:
+    """A pool of persistent HTTP connections, which threads can share.
+
+    Responses are requested with gzip compression. Up to MAX_REDIRECTS
+    redirects are followed, and any other 3xx status is an error. Requests
+    that fail with a network error, or with a 429 or 5xx status, are retried
+    with exponential backoff and jitter.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
+        self.timeout = timeout
+        self.retries = retries
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(list)
+
+    def _acquire(self, origin):
+        # Returns an idle connection to 'origin', and whether it was reused.
+        with self._lock:
+            if self._idle[origin]:
+                return self._idle[origin].pop(), True
+        scheme, host = origin
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, timeout=self.timeout), False
+        return http.client.HTTPConnection(host, timeout=self.timeout), False
+
+    def _release(self, origin, connection):
+        with self._lock:
+            self._idle[origin].append(connection)
+
+    def get(self, url, sleep_func=time.sleep):
+        """Send a GET request, and return the response as a stream."""
+        headers = {
+            'Accept-Encoding': 'gzip',
+            'User-Agent': 'lastexport.py/%s' % __version__,
+        }
+
+        attempt = 0
+        redirects = 0
+        while True:
+            parts = urllib.parse.urlsplit(url)
+            origin = (parts.scheme, parts.netloc)
+            path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            connection, reused = self._acquire(origin)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                if reused:
+                    # The server closed the idle connection, which is normal.
+                    continue
+                error = urllib.error.URLError(e)
+            else:
+                if response.status < 300:
+                    return SessionResponse(self, origin, connection, response)
+                error = urllib.error.HTTPError(url, response.status, response.reason,
+                                               response.headers, None)
+                response.read()
+                self._release(origin, connection)
+                location = response.getheader('Location')
+                if response.status in REDIRECT_STATUSES and location:
+                    location = urllib.parse.urljoin(url, location)
+                    if (redirects >= MAX_REDIRECTS or
+                            urllib.parse.urlsplit(location).scheme not in ('http', 'https')):
+                        raise error
+                    redirects += 1
+                    url = location
+                    continue
+                if response.status != 429 and response.status < 500:
+                    raise error
+
+            if attempt >= self.retries:
+                raise error
+            backoff(attempt, error, sleep_func)
+            attempt += 1
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class SessionResponse:
+    """The body of a response, decompressed if necessary.
+
+    Closing the response returns the connection to the session, if the whole
+    body has been read.
+    """
+    def __init__(self, session, origin, connection, response):
+        self._session = session
+        self._origin = origin
+        self._connection = connection
+        self._response = response
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            self._body = gzip.GzipFile(fileobj=response, mode='rb')
+        else:
+            self._body = response
+
+    def read(self, size=-1):
+        if size < 0:
+            # HTTPResponse would read until the server closes the connection.
+            return self._body.read()
+        return self._body.read(size)
+
+    def close(self):
+        if self._connection is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._session._release(self._origin, self._connection)
+        else:
+            self._connection.close()
+        self._connection = None
+
+def connect_server(server, username, startpage, sleep_func=time.sleep, tracktype='recenttracks',
+                   time_from=None, time_to=None, session=None):
+    """ Connect to server and get a XML page.
+
+    'time_from' and 'time_to' are UNIX timestamps that limit which tracks are
+    returned, so that pages don't shift when new tracks are scrobbled. Pass a
+    Session to reuse connections between requests.
+    """
     if server == "libre.fm":
         baseurl = 'http://alpha.libre.fm/2.0/?'
         urlvars = dict(method='user.get%s' % tracktype,
@@ -85,42 +242,77 @@ def connect_server(server, username, startpage, sleep_func=time.sleep, tracktype
                     page=startpage,
                     limit=200)
 
+    if time_from is not None:
+        urlvars['from'] = time_from
+    if time_to is not None:
+        urlvars['to'] = time_to
+
     url = baseurl + urllib.parse.urlencode(urlvars)
-    for interval in (1, 5, 10, 62):
-        try:
-            f = urllib.request.urlopen(url)
-            break
-        except Exception as e:
-            last_exc = e
-            log.warning("Exception occured while fetching last.fm listen "
-                        "history: %s. Retrying in %ds. Use --no-sync to disable "
-                        "network access.", e, interval)
-            sleep_func(interval)
-    else:
-        raise last_exc
+    if session is None:
+        session = Session()
+    return FilteredResponse(session.get(url, sleep_func))
+
+class FilteredResponse:
+    """Stream the response, removing U+FFFE characters.
+
+    last.fm sometimes sends U+FFFE, which isn't allowed in XML. The response
+    is read in chunks, so an encoded character may be split between two of
+    them.
+    """
+    BAD_BYTES = b'\xef\xbf\xbe'
+
+    def __init__(self, f):
+        self._f = f
+        self._pending = b''
+
+    def read(self, size=-1):
+        while True:
+            data = self._f.read(size)
+            eof = size < 0 or not data
+            data = (self._pending + data).replace(self.BAD_BYTES, b'')
+            self._pending = b''
+            if not eof:
+                # Hold back the start of a character that may be U+FFFE.
+                for n in (2, 1):
+                    if data.endswith(self.BAD_BYTES[:n]):
+                        data, self._pending = data[:-n], data[-n:]
+                        break
+            if data or eof:
+                return data
+
+    def close(self):
+        self._f.close()
 
-    response = f.read()
-    f.close()
+    def __enter__(self):
+        return self
 
-    #bad hack to fix bad xml
-    response = re.sub('\xef\xbf\xbe', '', response.decode())
-    return response
+    def __exit__(self, *args):
+        self.close()
 
-def get_pageinfo(response, tracktype='recenttracks'):
-    """Check how many pages of tracks the user have."""
-    xmlpage = ET.fromstring(response)
-    totalpages = xmlpage.find(tracktype).attrib.get('totalPages')
-    return int(totalpages)
+def parse_page(response, tracktype='recenttracks'):
+    """Parse an XML page as it is read, in a single pass.
 
-def get_tracklist(response):
-    """Read XML page and get a list of tracks and their info."""
-    xmlpage = ET.fromstring(response)
-    tracklist = xmlpage.getiterator('track')
-    return tracklist
+    Returns the total number of pages, and a list with the info of each track
+    on the page. The currently playing track is skipped.
+    """
+    totalpages = None
+    tracks = []
+    for event, element in ET.iterparse(response, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == tracktype:
+                totalpages = int(element.get('totalPages'))
+        elif element.tag == 'track':
+            # do not export the currently playing track.
+            if not element.get('nowplaying', None):
+                tracks.append(parse_track(element))
+            element.clear()
+    if totalpages is None:
+        raise ValueError("Response from server contains no %s." % tracktype)
+    return totalpages, tracks
 
 def parse_track(trackelement):
     """Extract info from every track entry and output to list."""
-    if trackelement.find('artist').getchildren():
+    if len(trackelement.find('artist')):
         #artist info is nested in loved/banned tracks xml
         artistname = trackelement.find('artist').find('name').text
         artistmbid = trackelement.find('artist').find('mbid').text
@@ -153,32 +345,90 @@ def write_tracks(tracks, outfileobj):
     for fields in tracks:
         outfileobj.write(("\t".join(fields) + "\n").encode('utf-8'))
 
-def get_tracks(server, username, startpage=1, sleep_func=time.sleep, tracktype='recenttracks'):
-    page = startpage
-    response = connect_server(server, username, page, sleep_func, tracktype)
-    totalpages = get_pageinfo(response, tracktype)
+class RateLimiter:
+    """Spaces out requests so that no more than 'rate' start each second."""
+    def __init__(self, rate, sleep_func=time.sleep):
+        self.interval = 1.0 / rate
+        self.sleep_func = sleep_func
+        self._lock = threading.Lock()
+        self._next = 0.0
 
-    if startpage > totalpages:
-        raise ValueError("First page (%s) is higher than total pages (%s)." % (startpage, totalpages))
+    def wait(self):
+        """Block until the next request may start. Safe to call from many threads."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            self.sleep_func(start - now)
 
-    while page <= totalpages:
-        #Skip connect if on first page, already have that one stored.
+def get_tracks(server, username, startpage=1, sleep_func=time.sleep, tracktype='recenttracks',
+               workers=1, requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+               time_from=None, time_to=None, session=None):
+    """Yield (page, totalpages, tracks) for each page, in page order.
 
-        if page > startpage:
-            response =  connect_server(server, username, page, sleep_func, tracktype)
+    Pages after the first are fetched by up to 'workers' threads at once, with
+    no more than 'requests_per_second' requests starting each second. See
+    connect_server() for 'time_from' and 'time_to'. If no Session is given,
+    one is created for these requests. Pages that time out or can't be parsed
+    are fetched again, as often as the session retries requests, and then
+    urllib.error.URLError is raised.
+    """
+    if session is None:
+        with Session() as session:
+            yield from _get_tracks(server, username, startpage, sleep_func, tracktype, workers,
+                                   requests_per_second, time_from, time_to, session)
+    else:
+        yield from _get_tracks(server, username, startpage, sleep_func, tracktype, workers,
+                               requests_per_second, time_from, time_to, session)
 
-        tracklist = get_tracklist(response)
-		
-        tracks = []
-        for trackelement in tracklist:
-            # do not export the currently playing track.
-            if not trackelement.attrib.get('nowplaying', None):
-                tracks.append(parse_track(trackelement))
+def _get_tracks(server, username, startpage, sleep_func, tracktype, workers,
+                requests_per_second, time_from, time_to, session):
+    limiter = RateLimiter(requests_per_second, sleep_func)
+
+    def fetch_page(page):
+        # The session retries failed requests, but the body can still time
+        # out or be cut short while it is parsed. Retry those pages too.
+        attempt = 0
+        while True:
+            limiter.wait()
+            try:
+                with connect_server(server, username, page, sleep_func, tracktype,
+                                    time_from, time_to, session) as response:
+                    return parse_page(response, tracktype)
+            except urllib.error.URLError:
+                raise
+            except (OSError, EOFError, zlib.error, http.client.HTTPException,
+                    ET.ParseError) as e:
+                error = urllib.error.URLError(e)
+            if attempt >= session.retries:
+                raise error
+            backoff(attempt, error, sleep_func)
+            attempt += 1
 
-        yield page, totalpages, tracks
+    totalpages, tracks = fetch_page(startpage)
 
-        page += 1
-        sleep_func(.5)
+    # There are no pages at all if no tracks match.
+    if startpage > max(totalpages, 1):
+        raise ValueError("First page (%s) is higher than total pages (%s)." % (startpage, totalpages))
+
+    yield startpage, totalpages, tracks
+
+    # Fetch a few pages ahead of the caller, and deliver them in order. When
+    # the caller stops early, pages that haven't started are cancelled.
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        page = startpage + 1
+        try:
+            while page <= totalpages or pending:
+                while page <= totalpages and len(pending) < workers * 2:
+                    pending.append((page, executor.submit(fetch_page, page)))
+                    page += 1
+                next_page, future = pending.popleft()
+                yield next_page, totalpages, future.result()[1]
+        finally:
+            for next_page, future in pending:
+                future.cancel()
 
 def main(server, username, startpage, outfile, infotype='recenttracks'):
     trackdict = dict()
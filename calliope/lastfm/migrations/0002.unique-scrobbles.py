@@ -0,0 +1,36 @@
+# Calliope -- database migrations for last.fm miner
+# Copyright (C) 2015  Sam Thursfield <sam@afuera.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from yoyo import step
+
+__depends__ = {'0001.init'}
+
+
+# Older versions could store the same scrobble more than once. Keep the first
+# copy so that the unique index can be created.
+step(
+    'DELETE FROM imports_lastfm WHERE id NOT IN ('
+    '   SELECT MIN(id) FROM imports_lastfm '
+    '   GROUP BY datetime, trackname, artistname'
+    ')'
+)
+
+step(
+    'CREATE UNIQUE INDEX imports_lastfm_scrobble '
+    '   ON imports_lastfm (datetime, trackname, artistname)',
+    'DROP INDEX imports_lastfm_scrobble'
+)
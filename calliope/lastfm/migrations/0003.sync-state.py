@@ -0,0 +1,32 @@
+# Calliope -- database migrations for last.fm miner
+# Copyright (C) 2015  Sam Thursfield <sam@afuera.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from yoyo import step
+
+__depends__ = {'0002.unique-scrobbles'}
+
+
+# Progress of a sync that hasn't finished yet. The plays between 'time_from'
+# and 'time_to' still need to be fetched.
+step(
+    'CREATE TABLE sync_state_lastfm ('
+    '   id INTEGER UNIQUE PRIMARY KEY, '
+    '   time_from INTEGER NOT NULL, '
+    '   time_to INTEGER NOT NULL '
+    ')',
+    'DROP TABLE sync_state_lastfm'
+)
@@ -18,6 +18,7 @@
 import click
 import musicbrainzngs
 
+import functools
 import json
 import logging
 import sys
@@ -28,24 +29,17 @@ import calliope
 log = logging.getLogger(__name__)
 
 
-def add_musicbrainz_artist(cache, item):
-    artist_name = item['artist']
-
-    found, entry = cache.lookup('artist:{}'.format(artist_name))
-
-    if found:
-        log.debug("Found artist:{} in cache".format(artist_name))
+def _search_artist(artist_name):
+    log.debug("Didn't find artist:{} in cache, running remote query".format(artist_name))
+    result = musicbrainzngs.search_artists(artist=artist_name)['artist-list']
+    if result:
+        return result[0]
     else:
-        log.debug("Didn't find artist:{} in cache, running remote query".format(artist_name))
-        result = musicbrainzngs.search_artists(artist=artist_name)['artist-list']
-        if result:
-            entry = result[0]
-        else:
-            entry = None
+        return calliope.cache.NOT_FOUND
 
-        cache.store('artist:{}'.format(artist_name), entry)
 
-    if entry is None:
+def _set_artist(item, entry):
+    if entry is calliope.cache.NOT_FOUND:
         warnings = item.get('musicbrainz.warnings', [])
         warnings += ["Unable to find artist on musicbrainz"]
         item['musicbrainz.warnings'] = warnings
@@ -53,10 +47,32 @@ def add_musicbrainz_artist(cache, item):
         item['musicbrainz.artist'] = entry['id']
         if 'country' in entry:
             item['musicbrainz.artist.country'] = entry['country']
+    return item
+
 
+def _get_artist_urls(artist_name, artist_musicbrainz_id):
+    log.debug("Didn't find artist urls for {} in cache, running remote query".format(artist_name))
+    result = musicbrainzngs.get_artist_by_id(artist_musicbrainz_id, includes='url-rels')
+    return result['artist'].get('url-relation-list', [])
+
+
+def _set_artist_urls(item, result_urls):
+    item_urls = item.get('musicbrainz.artist.urls', [])
+    for result_url in result_urls:
+        item_urls.append(
+            { 'musicbrainz.url.type': result_url['type'], 'musicbrainz.url.target': result_url['target'] })
+    item['musicbrainz.artist.urls'] = item_urls
     return item
 
 
+def add_musicbrainz_artist(cache, item):
+    artist_name = item['artist']
+
+    entry = cache.wrap('artist:{}'.format(artist_name),
+                       lambda: _search_artist(artist_name))
+    return _set_artist(item, entry)
+
+
 def add_musicbrainz_artist_urls(cache, item):
     if 'musicbrainz.artist' not in item:
         # We assume add_musicbrainz_artist() was already called, so
@@ -65,39 +81,74 @@ def add_musicbrainz_artist_urls(cache, item):
     else:
         artist_name = item['artist']
         artist_musicbrainz_id = item['musicbrainz.artist']
-        found, result_urls = cache.lookup('artist:{}:urls'.format(artist_musicbrainz_id))
-        if found:
-            log.debug("Found artist urls for {} in cache".format(artist_name))
-        else:
-            log.debug("Didn't find artist urls for {} in cache, running remote query".format(artist_name))
+        result_urls = cache.wrap('artist:{}:urls'.format(artist_musicbrainz_id),
+                                 lambda: _get_artist_urls(artist_name, artist_musicbrainz_id))
+        item = _set_artist_urls(item, result_urls)
+    return item
 
-            result = musicbrainzngs.get_artist_by_id(item['musicbrainz.artist'], includes='url-rels')
 
-            result_urls = result['artist'].get('url-relation-list', [])
+def _annotate_batch(cache, items, include):
+    def search_artist(item):
+        try:
+            return _search_artist(item['artist'])
+        except RuntimeError as e:
+            raise RuntimeError("%s\nItem: %s" % (e, item))
 
-            cache.store('artist:{}:urls'.format(artist_musicbrainz_id), result_urls)
+    def needs_artist(item):
+        return 'artist' in item and 'musicbrainz.artist' not in item
 
-        item_urls = item.get('musicbrainz.artist.urls', [])
-        for result_url in result_urls:
-            item_urls.append(
-                { 'musicbrainz.url.type': result_url['type'], 'musicbrainz.url.target': result_url['target'] })
-        item['musicbrainz.artist.urls'] = item_urls
-    return item
+    calls = {'artist:{}'.format(item['artist']): functools.partial(search_artist, item)
+             for item in items if needs_artist(item)}
+    entries = cache.wrap_many(calls)
+    for item in items:
+        if needs_artist(item):
+            _set_artist(item, entries['artist:{}'.format(item['artist'])])
 
+    if 'urls' in include:
+        calls = {'artist:{}:urls'.format(item['musicbrainz.artist']):
+                    functools.partial(_get_artist_urls, item['artist'], item['musicbrainz.artist'])
+                 for item in items if 'musicbrainz.artist' in item}
+        entries = cache.wrap_many(calls)
+        for item in items:
+            if 'musicbrainz.artist' in item:
+                _set_artist_urls(item, entries['artist:{}:urls'.format(item['musicbrainz.artist'])])
+
+    return items
 
-def annotate(playlist, include):
-    cache = calliope.cache.open(namespace='musicbrainz')
 
+def _open_cache():
     musicbrainzngs.set_useragent("Calliope", "0.1", "https://github.com/ssssam/calliope")
+    return calliope.cache.open(namespace='musicbrainz')
+
+
+def annotate(playlist, include):
+    cache = _open_cache()
+    yield from calliope.playlist.annotate_batches(
+        playlist, cache, functools.partial(_annotate_batch, cache, include=include))
+
+
+def warm(playlist, include, max_workers=4):
+    '''Fetch the cache entries that annotate() would need for 'playlist'.
+
+    Returns the number of entries that were fetched.
+
+    '''
+    cache = _open_cache()
 
-    for item in playlist:
-        if 'artist' in item and 'musicbrainz.artist' not in item:
-            try:
-                item = add_musicbrainz_artist(cache, item)
-            except RuntimeError as e:
-                raise RuntimeError("%s\nItem: %s" % (e, item))
+    artists = sorted({item['artist'] for item in playlist if 'artist' in item})
+    calls = {'artist:{}'.format(artist): functools.partial(_search_artist, artist)
+             for artist in artists}
+    count = cache.warm(calls, max_workers)
 
-        if 'urls' in include:
-            item = add_musicbrainz_artist_urls(cache, item)
+    if 'urls' in include:
+        entries = cache.lookup_many(calls.keys())
+        calls = {}
+        for artist in artists:
+            entry = entries.get('artist:{}'.format(artist))
+            if entry is not None and entry is not calliope.cache.NOT_FOUND:
+                calls['artist:{}:urls'.format(entry['id'])] = \
+                    functools.partial(_get_artist_urls, artist, entry['id'])
+        count += cache.warm(calls, max_workers)
 
-        yield item
+    cache.close()
+    return count
@@ -17,20 +17,163 @@
 
 import splitstream
 
+import collections
+import collections.abc
+import concurrent.futures
 import enum
+import gzip
+import hashlib
+import io
+import itertools
 import json
+import mmap
+import os
+import struct
 import sys
+import threading
+import time
+
+try:
+    # orjson is a much faster JSON parser, which we use if it's available.
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    # orjson shares one copy of each property name between the objects that it
+    # decodes. The json module makes a new string every time, so intern them.
+    _json_decoder = json.JSONDecoder(
+        object_pairs_hook=lambda pairs: {sys.intern(k): v for k, v in pairs})
+
+    def _loads(text):
+        if not isinstance(text, str):
+            text = text.decode('utf-8')
+        return _json_decoder.decode(text)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 class PlaylistError(RuntimeError):
     pass
 
 
-class Item(dict):
-    '''Represents a single item in a Calliope playlist.'''
-    def __init__(self, data):
-        # FIXME: let's not be this dumb.
-        self.update(data)
+# Properties that most items have, which Item stores in slots.
+_CORE_SLOTS = {
+    'artist': '_artist',
+    'album': '_album',
+    'track': '_track',
+    'location': '_location',
+}
+
+# Marks an empty slot in an Item.
+_MISSING = object()
+
+
+class Item(collections.abc.MutableMapping):
+    '''Represents a single item in a Calliope playlist.
+
+    Items behave like dicts. Large collections can contain millions of items,
+    so items are stored compactly: the 'artist', 'album', 'track' and
+    'location' properties are kept in slots, and the names of the other
+    properties are interned so that every item shares one copy of each. The
+    'data' mapping is not kept or modified.
+
+    Unlike a dict, an item doesn't remember where the core properties were
+    added. Iterating over an item, and writing it out, always gives 'artist',
+    'album', 'track' and 'location' first, followed by the other properties in
+    the order that they were added.
+
+    '''
+    __slots__ = ('_artist', '_album', '_track', '_location', '_extra')
+
+    def __init__(self, data=()):
+        if not isinstance(data, collections.abc.Mapping):
+            data = dict(data)
+        get = data.get
+        self._artist = get('artist', _MISSING)
+        self._album = get('album', _MISSING)
+        self._track = get('track', _MISSING)
+        self._location = get('location', _MISSING)
+        self._extra = {sys.intern(key): value for key, value in data.items()
+                       if key not in _CORE_SLOTS}
+
+    def __getitem__(self, key):
+        slot = _CORE_SLOTS.get(key)
+        if slot is None:
+            return self._extra[key]
+        value = getattr(self, slot)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        slot = _CORE_SLOTS.get(key)
+        if slot is None:
+            self._extra[sys.intern(key)] = value
+        else:
+            setattr(self, slot, value)
+
+    def __delitem__(self, key):
+        slot = _CORE_SLOTS.get(key)
+        if slot is None:
+            del self._extra[key]
+        elif getattr(self, slot) is _MISSING:
+            raise KeyError(key)
+        else:
+            setattr(self, slot, _MISSING)
+
+    def __contains__(self, key):
+        slot = _CORE_SLOTS.get(key)
+        if slot is None:
+            return key in self._extra
+        return getattr(self, slot) is not _MISSING
+
+    def get(self, key, default=None):
+        slot = _CORE_SLOTS.get(key)
+        if slot is None:
+            return self._extra.get(key, default)
+        value = getattr(self, slot)
+        return default if value is _MISSING else value
+
+    def __iter__(self):
+        for key, slot in _CORE_SLOTS.items():
+            if getattr(self, slot) is not _MISSING:
+                yield key
+        yield from self._extra
+
+    def __len__(self):
+        return (sum(getattr(self, slot) is not _MISSING
+                    for slot in _CORE_SLOTS.values()) +
+                len(self._extra))
+
+    def __repr__(self):
+        return 'Item({!r})'.format(self._to_dict())
+
+    def __reduce__(self):
+        return (_adopt_item, (self._to_dict(),))
+
+    def _to_dict(self):
+        # Faster than dict(self), which goes through __iter__ and __getitem__.
+        result = {}
+        if self._artist is not _MISSING:
+            result['artist'] = self._artist
+        if self._album is not _MISSING:
+            result['album'] = self._album
+        if self._track is not _MISSING:
+            result['track'] = self._track
+        if self._location is not _MISSING:
+            result['location'] = self._location
+        result.update(self._extra)
+        return result
+
+    def copy(self):
+        return Item(self)
 
     def id(self):
         if 'id' in self:
@@ -43,21 +186,81 @@ class Item(dict):
 
         In many cases one item corresponds to one track. However, this isn't
         guaranteed. For example a playlist may be a list of albums, each of
-        which contains multiple tracks.
+        which contains multiple tracks. These are returned as TrackView
+        objects, which don't copy any data from the album.
 
         '''
         if 'track' in self:
-            return self
-        elif 'album' in self and 'tracks' in self:
+            yield self
+        elif 'tracks' in self:
             for track in self['tracks']:
-                track_merged = copy.copy(track)
-                track_merged['album'] = self['album']
-                if self.get('artist') and 'artist' not in track_merged:
-                    track_merged['artist'] = self['artist']
-                yield track_merged
+                yield TrackView(self, track)
+
+
+def _adopt_item(data):
+    # Like Item(data), but for a dict that nothing else refers to, such as one
+    # that was just decoded. The core properties are popped into slots and the
+    # dict itself is kept, rather than copied. The names of the other
+    # properties are already shared between the dicts that the decoders return.
+    item = Item.__new__(Item)
+    pop = data.pop
+    item._artist = pop('artist', _MISSING)
+    item._album = pop('album', _MISSING)
+    item._track = pop('track', _MISSING)
+    item._location = pop('location', _MISSING)
+    item._extra = data
+    return item
+
+
+class TrackView(collections.abc.Mapping):
+    '''One track from an item that contains a list of tracks.
+
+    The view combines the properties of the track with the 'album' and
+    'artist' of the item that contains it. Nothing is copied, so walking the
+    tracks of a large collection doesn't use more memory. Views are read-only;
+    use `Item(view)` to get a copy that can be modified.
+
+    '''
+    __slots__ = ('_parent', '_track')
+
+    def __init__(self, parent, track):
+        self._parent = parent
+        self._track = track
+
+    def _inherited(self, key):
+        # Returns the value of 'key' that comes from the parent, or _MISSING.
+        if key == 'album':
+            return self._parent.get('album', _MISSING)
+        elif key == 'artist' and key not in self._track:
+            return self._parent.get('artist') or _MISSING
+        return _MISSING
+
+    def __getitem__(self, key):
+        value = self._inherited(key)
+        if value is _MISSING:
+            return self._track[key]
+        return value
+
+    def __iter__(self):
+        yield from self._track
+        for key in ('album', 'artist'):
+            if key not in self._track and self._inherited(key) is not _MISSING:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return 'TrackView({!r})'.format(dict(self))
+
+    id = Item.id
 
 
-def read(stream):
+# Amount of text that read() passes to each worker process.
+READ_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def read(stream, workers=None, keys=None):
     '''Parses a playlist from the given stream.
 
     Returns an generator that produces calliope.playlist.Item objects.
@@ -77,22 +280,647 @@ def read(stream):
         with open('playlist.cpe', 'r') as f:
             playlist = list(calliope.playlist.read(f))
 
+    Playlists in the 'binary' format, and playlists compressed with gzip or
+    zstd, are detected automatically. See `write()`.
+
+    If 'workers' is more than 1, JSON playlists with one item per line are
+    split into chunks at line boundaries, and the chunks are parsed by that
+    many worker processes. Items are still produced in their original order.
+    Other playlists are parsed in this process as usual.
+
+    If 'keys' is given, each item only keeps the properties named in 'keys'.
+    The other properties are dropped as soon as each item is decoded, so
+    they cost less memory and are not passed back from worker processes.
+
     '''
-    for text in splitstream.splitfile(stream, format='json'):
+    stream = _decompress(stream)
+
+    binary_stream = _detect_binary(stream)
+    if binary_stream is not None:
+        yield from _read_binary(binary_stream, keys)
+        return
+
+    if workers is not None and workers > 1:
+        yield from _read_parallel(stream, workers, keys)
+        return
+
+    # Most playlists are written by write(), with one JSON document per line,
+    # so we parse them a line at a time. If we meet a line that isn't a whole
+    # JSON document, we pass the rest of the stream to splitstream, which can
+    # split up any sequence of JSON documents.
+    while True:
+        line = stream.readline()
+        if not line:
+            return
+        if not line.strip():
+            continue
+        try:
+            json_document = _loads(line)
+        except ValueError:
+            yield from _read_documents(stream, line, keys)
+            return
+        yield from _items_from_document(json_document, keys)
+
+
+def _read_chunk(stream):
+    # Returns the next READ_CHUNK_SIZE or so of the stream, ending at the end
+    # of a line.
+    chunk = stream.read(READ_CHUNK_SIZE)
+    if chunk:
+        chunk += stream.readline()
+    return chunk
+
+
+def _decode_lines(chunk, keys):
+    # Runs in the worker processes of _read_parallel(). Raises ValueError if
+    # the chunk isn't one JSON document per line. We split only on '\n', as
+    # str.splitlines() also splits on characters that can appear in strings.
+    newline = b'\n' if isinstance(chunk, bytes) else '\n'
+    return [_project(_loads(line), keys) for line in chunk.split(newline)
+            if line.strip()]
+
+
+def _read_parallel(stream, workers, keys):
+    # We parse the first chunk here. This avoids starting any processes for
+    # small playlists, and lets us fall back to splitstream if the playlist
+    # isn't one JSON document per line.
+    chunk = _read_chunk(stream)
+    try:
+        json_documents = _decode_lines(chunk, keys)
+    except ValueError:
+        yield from _read_documents(stream, chunk, keys)
+        return
+    for json_document in json_documents:
+        yield from _items_from_document(json_document)
+
+    chunk = _read_chunk(stream)
+    if not chunk:
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        # Results are collected in the order the chunks were read. We only
+        # read ahead a few chunks per worker so memory use stays bounded.
+        pending = collections.deque()
+        while chunk or pending:
+            while chunk and len(pending) < workers * 2:
+                pending.append(executor.submit(_decode_lines, chunk, keys))
+                chunk = _read_chunk(stream)
+            try:
+                json_documents = pending.popleft().result()
+            except ValueError as e:
+                raise PlaylistError("Invalid JSON in playlist. Playlists can "
+                                    "only be read in parallel if they contain "
+                                    "one item per line.") from e
+            for json_document in json_documents:
+                yield from _items_from_document(json_document)
+
+
+def _peek(stream, size):
+    # Returns the underlying binary stream of 'stream' and its first 'size'
+    # bytes, without consuming anything. Returns (None, None) if the stream
+    # can't be peeked.
+    raw = getattr(stream, 'buffer', stream)
+    if hasattr(raw, 'peek'):
+        return raw, raw.peek(size)[:size]
+    elif raw.seekable():
+        position = raw.tell()
+        head = raw.read(size)
+        raw.seek(position)
+        return raw, head
+    else:
+        return None, None
+
+
+def _detect_binary(stream):
+    # Returns the underlying binary stream if 'stream' contains a playlist in
+    # the binary format, or None otherwise. Nothing is consumed from 'stream'.
+    raw, head = _peek(stream, len(BINARY_MAGIC))
+    if head == BINARY_MAGIC:
+        return raw
+    return None
+
+
+def _detect_compression(head):
+    for compression, magic in _COMPRESSION_MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def _decompress(stream):
+    # Returns a stream of the decompressed contents if 'stream' is compressed,
+    # or 'stream' itself otherwise.
+    raw, head = _peek(stream, _COMPRESSION_MAGIC_SIZE)
+    if not isinstance(head, bytes):
+        # We can't peek the stream, or it only contains text.
+        return stream
+    compression = _detect_compression(head)
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise PlaylistError("Reading zstd-compressed playlists requires "
+                                "the 'zstandard' Python module.")
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            raw, read_across_frames=True, closefd=False)
+        return io.BufferedReader(reader, buffer_size=WRITE_BUFFER_SIZE)
+    return stream
+
+
+def _read_binary(stream, keys=None):
+    if msgpack is None:
+        raise PlaylistError("Reading binary playlists requires the 'msgpack' "
+                            "Python module.")
+    while True:
+        header = stream.read(_BINARY_LENGTH.size)
+        if not header:
+            return
+        if header == BINARY_MAGIC:
+            # Each call to write() starts with the magic number, so it can
+            # appear again if several writes went to the same stream.
+            continue
+        if len(header) < _BINARY_LENGTH.size:
+            raise PlaylistError("Binary playlist is truncated")
+        size, = _BINARY_LENGTH.unpack(header)
+        data = stream.read(size)
+        if len(data) < size:
+            raise PlaylistError("Binary playlist is truncated")
+        yield from _items_from_document(msgpack.unpackb(data, raw=False), keys)
+
+
+class _EncodedReader():
+    # splitstream can only read from binary streams.
+    def __init__(self, stream):
+        self._stream = stream
+
+    def read(self, size=-1):
+        return self._stream.read(size).encode('utf-8')
+
+
+def _read_documents(stream, preamble, keys=None):
+    if isinstance(preamble, str):
+        stream = _EncodedReader(stream)
+        preamble = preamble.encode('utf-8')
+    for text in splitstream.splitfile(stream, format='json', preamble=preamble):
         try:
-            json_document = json.loads(text)
+            json_document = _loads(text)
         except ValueError as e:
             raise PlaylistError from e
-        if isinstance(json_document, dict):
-            yield Item(json_document)
-        elif isinstance(json_document, list):
-            yield from (Item(item) for item in json_document)
+        yield from _items_from_document(json_document, keys)
+
+
+def _project(json_document, keys):
+    # Returns the JSON document with only the properties named in 'keys'.
+    if keys is None:
+        return json_document
+    if isinstance(json_document, dict):
+        return {key: json_document[key] for key in keys if key in json_document}
+    elif isinstance(json_document, list):
+        return [_project(item, keys) for item in json_document]
+    return json_document
+
+
+def _items_from_document(json_document, keys=None):
+    # The decoded objects belong to nobody else, so the items can keep them.
+    json_document = _project(json_document, keys)
+    if isinstance(json_document, dict):
+        yield _adopt_item(json_document)
+    elif isinstance(json_document, list):
+        yield from (_adopt_item(item) if isinstance(item, dict) else Item(item)
+                    for item in json_document)
+    else:
+        raise PlaylistError("Expected JSON object, got {}".format(type(json_document).__name__))
+
+
+def batches(items, size):
+    '''Split a sequence of playlist items into lists of 'size' items.
+
+    This is useful for tools which can process several items more efficiently
+    than one at a time, for example by reading all of the cache entries they
+    need in one operation. The last list may be shorter than 'size'.
+
+    '''
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# Number of items that annotate_batches() passes to each call.
+ANNOTATE_BATCH_SIZE = 100
+
+
+def annotate_batches(playlist, cache, annotate_batch, size=ANNOTATE_BATCH_SIZE):
+    '''Annotate a playlist with data from a remote service, a batch at a time.
+
+    'annotate_batch' is called with each list of items, and returns the
+    annotated items. It should read every cache entry that the batch needs in
+    one go, for example with `Cache.wrap_many()`, so that remote queries are
+    only run for entries that are missing or out of date.
+
+    The cache is closed when the playlist ends, or when the caller stops
+    early. This cancels any background refreshes that haven't started, which
+    would otherwise delay the exit of the process.
+
+    '''
+    try:
+        for items in batches(playlist, size):
+            yield from annotate_batch(items)
+    finally:
+        cache.close()
+
+
+# Playlist formats that write() can produce.
+FORMATS = ['json', 'binary']
+
+# A binary playlist starts with this, which can't be the start of JSON text.
+BINARY_MAGIC = b'\xc1CPE'
+
+# Each item in a binary playlist is preceded by its size.
+_BINARY_LENGTH = struct.Struct('!I')
+
+# write() collects this many bytes of output before writing it to the stream.
+WRITE_BUFFER_SIZE = 64 * 1024
+
+# Pending output is written if it has been waiting for this many seconds.
+WRITE_FLUSH_INTERVAL = 1.0
+
+
+# Compression methods for write(). read() detects them from these magic
+# numbers.
+COMPRESSIONS = ['gzip', 'zstd']
+
+_COMPRESSION_MAGIC = {
+    'gzip': b'\x1f\x8b',
+    'zstd': b'\x28\xb5\x2f\xfd',
+}
+_COMPRESSION_MAGIC_SIZE = max(len(magic) for magic in _COMPRESSION_MAGIC.values())
+
+
+def write(items, stream, format='json', compression=None):
+    '''Write a playlist to the given stream.
+
+    By default the playlist is written as JSON, one item per line. The
+    'binary' format is faster for other Calliope tools to read, but it can
+    only be read by Calliope. Each item is encoded with MessagePack and
+    preceded by its length, and the 'msgpack' module is required. Binary
+    playlists are written to the binary buffer of text streams such as
+    sys.stdout.
+
+    Items are encoded into a buffer which is written to the stream in large
+    blocks. Output is still written promptly when the items are produced
+    slowly, for example when they come from a remote API: pending output is
+    written once it is WRITE_FLUSH_INTERVAL seconds old, even while waiting
+    for the next item, and after every item if the stream is a terminal. The
+    stream is flushed before returning.
+
+    Set 'compression' to 'gzip' or 'zstd' to compress the output, which is
+    then written to the binary buffer of text streams. zstd compression
+    requires the 'zstandard' module. Each call to write() produces a complete
+    gzip member or zstd frame, so compressed output from several calls can be
+    concatenated.
+
+    '''
+    interactive = stream.isatty()
+    if format == 'json' and compression is None:
+        encode = _encode_json
+        empty = ''
+        header = ''
+    elif format == 'json':
+        stream.flush()
+        stream = getattr(stream, 'buffer', stream)
+        encode = _encode_json_utf8
+        empty = b''
+        header = b''
+    elif format == 'binary':
+        if msgpack is None:
+            raise PlaylistError("Writing binary playlists requires the "
+                                "'msgpack' Python module.")
+        stream.flush()
+        stream = getattr(stream, 'buffer', stream)
+        encode = _binary_encoder()
+        empty = b''
+        header = BINARY_MAGIC
+    else:
+        raise PlaylistError("Unknown playlist format: {}".format(format))
+
+    raw_stream = stream
+    if compression is not None:
+        stream = _compressor(raw_stream, compression)
+
+    # Output is collected in 'buffer'. A background thread writes it out
+    # once it is WRITE_FLUSH_INTERVAL seconds old, so that it isn't held back
+    # while we wait for the next item. The thread never needs to be woken up
+    # by the loop below, which would slow it down; it checks the age of the
+    # buffer at least every WRITE_FLUSH_INTERVAL seconds instead.
+    buffer = [header]
+    buffer_size = len(header)
+    buffer_since = None
+    lock = threading.Lock()
+    closed = threading.Event()
+    flusher = None
+    flusher_error = None
+
+    def flush():
+        nonlocal buffer_size, buffer_since
+        stream.write(empty.join(buffer))
+        stream.flush()
+        buffer.clear()
+        buffer_size = 0
+        buffer_since = None
+
+    def flush_when_old():
+        nonlocal flusher_error
+        timeout = WRITE_FLUSH_INTERVAL
+        while not closed.wait(timeout):
+            with lock:
+                timeout = WRITE_FLUSH_INTERVAL
+                if buffer_since is not None:
+                    age = time.monotonic() - buffer_since
+                    if age < WRITE_FLUSH_INTERVAL:
+                        timeout -= age
+                    else:
+                        try:
+                            flush()
+                        except Exception as e:
+                            flusher_error = e
+                            return
+
+    try:
+        for item in items:
+            data = encode(item)
+            with lock:
+                if flusher_error is not None:
+                    raise flusher_error
+                buffer.append(data)
+                buffer_size += len(data)
+                if interactive or buffer_size >= WRITE_BUFFER_SIZE:
+                    flush()
+                elif buffer_since is None:
+                    buffer_since = time.monotonic()
+                    if flusher is None:
+                        flusher = threading.Thread(target=flush_when_old,
+                                                   daemon=True)
+                        flusher.start()
+    finally:
+        closed.set()
+        if flusher is not None:
+            flusher.join()
+        # The items that were encoded are written out even if 'items' raised
+        # an exception, and compressed output is finished properly.
+        if flusher_error is None:
+            stream.write(empty.join(buffer))
+            if compression is not None:
+                # This doesn't close the underlying stream.
+                stream.close()
+            raw_stream.flush()
+    if flusher_error is not None:
+        raise flusher_error
+
+
+def _compressor(stream, compression):
+    if compression == 'gzip':
+        return gzip.GzipFile(filename='', fileobj=stream, mode='wb',
+                             compresslevel=6)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise PlaylistError("Writing zstd-compressed playlists requires "
+                                "the 'zstandard' Python module.")
+        return zstandard.ZstdCompressor().stream_writer(stream, closefd=False)
+    else:
+        raise PlaylistError("Unknown compression: {}".format(compression))
+
+
+def _mapping_to_dict(value):
+    # The json and msgpack modules only know how to encode real dicts.
+    if isinstance(value, Item):
+        return value._to_dict()
+    if isinstance(value, collections.abc.Mapping):
+        return dict(value)
+    raise TypeError("Cannot encode {} in a playlist".format(type(value).__name__))
+
+
+_encoder = json.JSONEncoder(default=_mapping_to_dict)
+
+
+def _encode_json(item):
+    return _encoder.encode(item) + '\n'
+
+
+def _encode_json_utf8(item):
+    return (_encoder.encode(item) + '\n').encode('utf-8')
+
+
+def _binary_encoder():
+    packer = msgpack.Packer(use_bin_type=True, default=_mapping_to_dict)
+
+    def encode(item):
+        data = packer.pack(item)
+        return _BINARY_LENGTH.pack(len(data)) + data
+    return encode
+
+
+# Layout of the index files used by IndexedPlaylist. The header is followed
+# by the offset of each item in the playlist file, then the end of the last
+# item, then the hash table of item IDs.
+_INDEX_MAGIC = b'CPEI'
+_INDEX_VERSION = 1
+# magic, version, playlist size, playlist mtime, number of items, ID slots
+_INDEX_HEADER = struct.Struct('<4sIQQQQ')
+_INDEX_OFFSET = struct.Struct('<Q')
+# hash of the ID, item number + 1 (or 0 if the slot is empty)
+_INDEX_SLOT = struct.Struct('<QQ')
+
+
+def _hash_id(item_id):
+    digest = hashlib.blake2b(item_id.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class IndexedPlaylist():
+    '''Random access to the items in a playlist file.
+
+    Items can be fetched by position with `playlist[n]`, or by `Item.id()`
+    with `find()`, without parsing the rest of the file. This makes it
+    practical to sample or page through very large collections. The file is
+    memory-mapped, so only the parts that are used are read from disk.
+
+    The position of each item is stored in an index file alongside the
+    playlist, named PATH.index. This is created when the playlist is opened,
+    or recreated if the playlist has changed since. Set 'index_ids' to also
+    index the item IDs, which `find()` requires.
+
+    The playlist must be in the binary format, or have one JSON object per
+    line as written by `write()`. It can't be compressed.
+
+    '''
+    def __init__(self, path, index_ids=False):
+        self.path = path
+        self.index_path = path + '.index'
+
+        self._file = open(path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        if stat.st_size > 0:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._data = b''
+        if _detect_compression(self._data[:_COMPRESSION_MAGIC_SIZE]):
+            raise PlaylistError("{}: Compressed playlists cannot be indexed."
+                                .format(path))
+        self._binary = self._data[:len(BINARY_MAGIC)] == BINARY_MAGIC
+        if self._binary and msgpack is None:
+            raise PlaylistError("Reading binary playlists requires the "
+                                "'msgpack' Python module.")
+
+        self._index = self._open_index(stat, index_ids)
+        if self._index is None:
+            self._build_index(stat, index_ids)
+            self._index = self._open_index(stat, index_ids)
+
+        header = _INDEX_HEADER.unpack_from(self._index)
+        self._count = header[4]
+        self._id_slots = header[5]
+        self._slots_start = (_INDEX_HEADER.size +
+                             (self._count + 1) * _INDEX_OFFSET.size)
+
+    def _open_index(self, stat, index_ids):
+        # Returns the index file contents, or None if it needs rebuilding.
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        if len(index) < _INDEX_HEADER.size:
+            return None
+        magic, version, size, mtime, count, id_slots = \
+            _INDEX_HEADER.unpack_from(index)
+        if (magic != _INDEX_MAGIC or version != _INDEX_VERSION or
+                size != stat.st_size or mtime != stat.st_mtime_ns or
+                (index_ids and id_slots == 0)):
+            index.close()
+            return None
+        return index
+
+    def _build_index(self, stat, index_ids):
+        offsets = []
+        data = self._data
+        if self._binary:
+            position = len(BINARY_MAGIC)
+            while position < len(data):
+                if data[position:position+len(BINARY_MAGIC)] == BINARY_MAGIC:
+                    position += len(BINARY_MAGIC)
+                    continue
+                size, = _BINARY_LENGTH.unpack_from(data, position)
+                offsets.append(position)
+                position += _BINARY_LENGTH.size + size
+        else:
+            position = 0
+            while position < len(data):
+                end = data.find(b'\n', position)
+                if end == -1:
+                    end = len(data)
+                line = data[position:end].strip()
+                if line:
+                    if not (line.startswith(b'{') and line.endswith(b'}')):
+                        raise PlaylistError(
+                            "{}: Indexed playlists must have one JSON object "
+                            "per line.".format(self.path))
+                    offsets.append(position)
+                position = end + 1
+        offsets.append(len(data))
+
+        id_slots = 0
+        slots = b''
+        if index_ids:
+            id_slots = 1
+            while id_slots < len(offsets) * 2:
+                id_slots *= 2
+            table = bytearray(id_slots * _INDEX_SLOT.size)
+            for n in range(len(offsets) - 1):
+                try:
+                    item = self._decode_range(offsets[n], offsets[n + 1])
+                    item_hash = _hash_id(item.id())
+                except AttributeError:
+                    # The item has no 'id', and no 'artist' or 'track'.
+                    continue
+                slot = item_hash % id_slots
+                while _INDEX_SLOT.unpack_from(table, slot * _INDEX_SLOT.size)[1] != 0:
+                    slot = (slot + 1) % id_slots
+                _INDEX_SLOT.pack_into(table, slot * _INDEX_SLOT.size, item_hash, n + 1)
+            slots = bytes(table)
+
+        header = _INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, stat.st_size,
+                                    stat.st_mtime_ns, len(offsets) - 1, id_slots)
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(header)
+            f.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+            f.write(slots)
+        os.replace(temp_path, self.index_path)
+
+    def _offset(self, n):
+        return _INDEX_OFFSET.unpack_from(
+            self._index, _INDEX_HEADER.size + n * _INDEX_OFFSET.size)[0]
+
+    def _decode_range(self, start, end):
+        if self._binary:
+            size, = _BINARY_LENGTH.unpack_from(self._data, start)
+            start += _BINARY_LENGTH.size
+            return _adopt_item(msgpack.unpackb(self._data[start:start+size],
+                                               raw=False))
         else:
-            raise PlaylistError("Expected JSON object, got {}".format(type(json_document).__name__))
+            return _adopt_item(_loads(self._data[start:end]))
+
+    def _decode(self, n):
+        return self._decode_range(self._offset(n), self._offset(n + 1))
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self._decode(i) for i in range(*n.indices(self._count))]
+        if n < 0:
+            n += self._count
+        if not 0 <= n < self._count:
+            raise IndexError("Playlist index out of range")
+        return self._decode(n)
+
+    def __iter__(self):
+        for n in range(self._count):
+            yield self._decode(n)
+
+    def find(self, item_id):
+        '''Return the item whose `Item.id()` is 'item_id'.
+
+        Raises KeyError if there is no such item.
+
+        '''
+        if self._id_slots == 0:
+            raise PlaylistError("Playlist was indexed without 'index_ids'")
+        item_hash = _hash_id(item_id)
+        slot = item_hash % self._id_slots
+        while True:
+            slot_hash, number = _INDEX_SLOT.unpack_from(
+                self._index, self._slots_start + slot * _INDEX_SLOT.size)
+            if number == 0:
+                raise KeyError(item_id)
+            if slot_hash == item_hash:
+                item = self._decode(number - 1)
+                if item.id() == item_id:
+                    return item
+            slot = (slot + 1) % self._id_slots
+
+    def close(self):
+        self._index.close()
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
 
+    def __enter__(self):
+        return self
 
-def write(items, stream):
-    '''Write a playlist to the given stream.'''
-    for item in items:
-        json.dump(item, stream)
-        stream.write('\n')
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,114 @@
+# Calliope
+# Copyright (C) 2018  Sam Thursfield <sam@afuera.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Select items and properties from a playlist.'''
+
+import logging
+import operator
+import re
+
+import calliope
+
+log = logging.getLogger(__name__)
+
+
+_PREDICATE_RE = re.compile(r'^(?P<key>[^=!<>~]+)(?P<op>!=|>=|<=|=|<|>|~)(?P<value>.*)$')
+
+_OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class Predicate():
+    '''A condition that an item must match to be selected.
+
+    The condition compares the value of one property with a string operand.
+    Numeric properties are compared as numbers, and other properties as
+    strings, so ISO 8601 dates compare in date order. If the property is a
+    list, the item matches if any element matches. Items which don't have
+    the property never match.
+
+    '''
+    def __init__(self, key, op, value):
+        self.key = key
+        self.op = op
+        self.value = value
+        if op == '~':
+            try:
+                self._regex = re.compile(value)
+            except re.error as e:
+                raise RuntimeError("Invalid regular expression '{}': {}"
+                                   .format(value, e)) from e
+        else:
+            self._compare = _OPERATORS[op]
+            try:
+                self._number = float(value)
+            except ValueError:
+                self._number = None
+
+    def __repr__(self):
+        return 'Predicate({!r}{}{!r})'.format(self.key, self.op, self.value)
+
+    def __call__(self, item):
+        value = item.get(self.key)
+        if value is None:
+            return False
+        if isinstance(value, list):
+            return any(self._match(element) for element in value)
+        return self._match(value)
+
+    def _match(self, value):
+        if self.op == '~':
+            return self._regex.search(str(value)) is not None
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            if self._number is None:
+                return False
+            return self._compare(value, self._number)
+        return self._compare(str(value), self.value)
+
+
+def parse_predicate(text):
+    '''Parse a condition such as 'lastfm.playcount>=10'.
+
+    The operators are =, !=, <, <=, >, >= and ~, which matches a regular
+    expression.
+
+    '''
+    match = _PREDICATE_RE.match(text)
+    if match is None:
+        raise RuntimeError("Invalid condition '{}'. Expected KEY, an operator "
+                           "and a value, such as 'artist=Björk'.".format(text))
+    return Predicate(match.group('key').strip(), match.group('op'),
+                     match.group('value'))
+
+
+def select(playlist, keys=None, predicates=()):
+    '''Select the items that match every predicate.
+
+    If 'keys' is given, only those properties are kept in each item.
+
+    '''
+    for item in playlist:
+        if all(predicate(item) for predicate in predicates):
+            if keys:
+                item = calliope.playlist.Item(
+                    {key: item[key] for key in keys if key in item})
+            yield item
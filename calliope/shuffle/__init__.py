@@ -63,3 +63,16 @@ def shuffle(playlist, count):
         corpus = corpus[0:count]
 
     return corpus
+
+
+def shuffle_indexed(playlist, count):
+    '''Shuffle a calliope.playlist.IndexedPlaylist.
+
+    Only the items that are returned get read, so this is much faster than
+    shuffle() when picking a few items from a large collection.
+
+    '''
+    if not count or count > len(playlist):
+        count = len(playlist)
+    for n in random.sample(range(len(playlist)), count):
+        yield playlist[n]
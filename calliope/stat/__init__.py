@@ -42,7 +42,7 @@ def measure_size(playlist):
         if 'location' in item:
             size += measure_one(item)
         elif 'tracks' in item:
-            for track in item['tracks']:
+            for track in item.tracks():
                 if 'location' in track:
                     size += measure_one(track)
     print("Total size: %i MB" % (size / 1024 / 1024.0))
@@ -140,7 +140,7 @@ def sync(dry_run, target, allow_formats, album_per_dir, number_dirs,
                 sync_track(item['location'], target, allow_formats,
                             target_filename=filename))
         elif 'tracks' in item:
-            for track_number, track_item in enumerate(item['tracks']):
+            for track_number, track_item in enumerate(item.tracks()):
                 if 'location' in track_item:
                     path = calliope.uri_to_path(track_item['location'])
                     if number_files:
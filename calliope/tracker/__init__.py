@@ -387,7 +387,7 @@ def execute_sparql(tracker, query):
 def expand_tracks(tracker, playlist):
     for item in playlist:
         if 'track' in item or 'tracks' in item:
-            yield item
+            yield from item.tracks()
         elif 'album' in item:
             yield from tracker.tracks(filter_artist_name=item['artist'],
                                       filter_album_name=item['album'])
@@ -19,10 +19,21 @@ import pytest
 
 import calliope
 
+import functools
+import io
+import multiprocessing
+import subprocess
+import sys
 import threading
+import time
 
 
-KINDS = [calliope.cache.GdbmCache]
+KINDS = [
+    pytest.param(calliope.cache.GdbmCache,
+                 marks=pytest.mark.skipif(not calliope.cache.HAVE_GDBM,
+                                          reason="GDBM is not available")),
+    calliope.cache.SqliteCache,
+]
 
 
 @pytest.fixture
@@ -66,6 +77,143 @@ def test_null_value(cache):
     assert returned_value == value
 
 
+@pytest.mark.parametrize('kind', KINDS)
+def test_many(cache):
+    '''Store and retrieve several values at once.'''
+    values = {'test:%i' % i: {'number': i} for i in range(0, 1200)}
+
+    assert cache.lookup_many(values.keys()) == {}
+
+    cache.store_many(values)
+
+    assert cache.lookup_many(values.keys()) == values
+    assert cache.lookup_many(['test:1', 'missing']) == {'test:1': {'number': 1}}
+    assert cache.lookup('test:1199') == (True, {'number': 1199})
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_expiry(cache):
+    '''Test that wrap() refreshes entries which are older than the TTL.'''
+    calls = []
+    def call():
+        calls.append(True)
+        return len(calls)
+
+    assert cache.wrap('foo', call) == 1
+    assert cache.wrap('foo', call) == 1
+
+    cache.ttl = 0
+    assert cache.lookup('foo') == (False, None)
+    assert cache.wrap('foo', call) == 2
+
+    cache.ttl = 3600
+    assert cache.lookup('foo') == (True, 2)
+    assert cache.wrap('foo', call) == 2
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_negative_entry(cache):
+    '''Test that negative entries are distinct from None and expire sooner.'''
+    NOT_FOUND = calliope.cache.NOT_FOUND
+    calls = []
+    def call():
+        calls.append(True)
+        return NOT_FOUND
+
+    cache.store('null', None)
+    assert cache.wrap('foo', call) is NOT_FOUND
+    assert cache.wrap('foo', call) is NOT_FOUND
+    assert len(calls) == 1
+    assert cache.lookup('foo') == (True, NOT_FOUND)
+    assert cache.lookup('null') == (True, None)
+
+    cache.negative_ttl = 0
+    assert cache.lookup('foo') == (False, None)
+    assert cache.lookup('null') == (True, None)
+    assert cache.wrap('foo', call) is NOT_FOUND
+    assert len(calls) == 2
+
+    cache.negative_ttl = 3600
+    cache.compress = True
+    cache.store_negative('bar')
+    assert cache.lookup('bar') == (True, NOT_FOUND)
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_stale_while_revalidate(kind, tmpdir):
+    '''Test that expired entries can be refreshed in the background.'''
+    cache = kind('test', cachedir=tmpdir)
+    cache.store('foo', 'old')
+
+    cache.ttl = 0
+    cache.stale_while_revalidate = True
+    assert cache.wrap('foo', lambda: 'new') == 'old'
+
+    # Closing the cache waits for the background refresh to complete.
+    cache.close()
+
+    cache = kind('test', cachedir=tmpdir)
+    assert cache.lookup('foo') == (True, 'new')
+
+    # Only a limited number of refreshes are queued, and closing the cache
+    # cancels the ones that haven't started.
+    keys = ['key{}'.format(i) for i in range(calliope.cache.MAX_PENDING_REFRESHES * 2)]
+    for key in keys:
+        cache.store(key, 'old')
+    cache.ttl = 0
+    cache.stale_while_revalidate = True
+    calls = []
+    started = threading.Event()
+
+    def slow_call(key):
+        calls.append(key)
+        started.set()
+        time.sleep(0.2)
+        return 'new'
+
+    for key in keys:
+        assert cache.wrap(key, functools.partial(slow_call, key)) == 'old'
+    started.wait()
+    assert len(cache._refreshing) == calliope.cache.MAX_PENDING_REFRESHES
+    start_time = time.time()
+    cache.close()
+    assert time.time() - start_time < 1
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_legacy_entry(cache):
+    '''Read an entry written by an older version of Calliope.'''
+    cache._write({'foo': b'{"a": 5}'})
+    assert cache.lookup('foo') == (True, {'a': 5})
+
+    # We don't know how old the entry is, so it has expired if there's a TTL.
+    cache.ttl = 3600
+    assert cache.lookup('foo') == (False, None)
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_legacy_negative_entry(cache):
+    '''Read a None that an older version stored for an unknown artist.'''
+    cache._write({'artist:foo': b'null', 'other:foo': b'null'})
+    assert cache.lookup('other:foo') == (True, None)
+
+    # We don't know how old the entry is, so it's looked up again once.
+    calls = []
+    def query():
+        calls.append(1)
+        return calliope.cache.NOT_FOUND
+    assert cache.wrap('artist:foo', query) is calliope.cache.NOT_FOUND
+    assert cache.wrap('artist:foo', query) is calliope.cache.NOT_FOUND
+    assert len(calls) == 1
+
+    # None stored by this version is an ordinary value.
+    cache.store('artist:bar', None)
+    assert cache.lookup('artist:bar') == (True, None)
+    assert cache.wrap('artist:bar', query) is None
+    assert len(calls) == 1
+
+
 class Counter():
     '''Helper class used by benchmark tests.'''
     def __init__(self, limit=None):
@@ -147,3 +295,215 @@ def test_concurrent_writes(kind, tmpdir):
         found, value = cache.lookup('test:%i' % i)
         assert found
         assert len(value) == 100
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_multiple_handles(kind, tmpdir):
+    '''Test that flushed writes are visible to other handles on a cache.'''
+    cache1 = kind('test', cachedir=tmpdir)
+    cache2 = kind('test', cachedir=tmpdir)
+
+    assert cache2.lookup('foo') == (False, None)
+
+    cache1.store('foo', 1)
+    cache1.flush()
+    assert cache2.lookup('foo') == (True, 1)
+
+    cache2.store('foo', 2)
+    cache2.store('bar', 3)
+    cache2.flush()
+    assert cache1.lookup('foo') == (True, 2)
+    assert cache1.lookup('bar') == (True, 3)
+
+    cache1.close()
+    cache2.close()
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_compression(kind, tmpdir):
+    '''Test storing values compressed with a trained dictionary.'''
+    def value(i):
+        return {'id': i, 'type': 'artist', 'country': 'GB',
+                'tags': ['electronic', 'experimental', 'ambient']}
+
+    cache = kind('test', cachedir=tmpdir)
+    cache.compress = True
+    for i in range(0, 2000):
+        cache.store('test:%i' % i, value(i))
+    cache.close()
+
+    cache = kind('test', cachedir=tmpdir)
+    entries = cache._read(['test:0', 'test:1999'])
+    assert len(entries['test:1999']) < len(calliope.cache._dumps(value(1999)))
+    for i in range(0, 2000):
+        assert cache.lookup('test:%i' % i) == (True, value(i))
+    cache.close()
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_lookup_counts_saved_at_exit(kind, tmpdir):
+    '''Test that lookup counts are saved even if the cache isn't closed.'''
+    cache = kind('test', cachedir=tmpdir)
+    cache.store('foo', 1)
+    cache.close()
+
+    script = (
+        'import calliope\n'
+        'cache = calliope.cache.{}("test", cachedir={!r})\n'
+        'cache.lookup_many(["foo", "bar"])\n'.format(kind.__name__, str(tmpdir)))
+    subprocess.run([sys.executable, '-c', script], check=True)
+
+    cache = kind('test', cachedir=tmpdir)
+    stats = cache.stats()
+    assert (stats['lookups'], stats['hits']) == (2, 1)
+    cache.close()
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_persistent_values(kind, tmpdir):
+    '''Test values that aren't subject to the TTL or to pruning.'''
+    cache = kind('test', cachedir=tmpdir)
+    cache.set_persistent('token', 'secret')
+    cache.store('foo', 1)
+    cache.ttl = 0
+    assert cache.lookup('foo') == (False, None)
+    assert cache.lookup_entry('foo').value == 1
+    assert cache.lookup_entry('bar') is None
+
+    assert cache.keys() == ['foo']
+    assert cache.prune(stored_before=time.time() + 60) == 1
+    cache.close()
+
+    cache = kind('test', cachedir=tmpdir)
+    assert cache.get_persistent('token') == 'secret'
+    assert cache.get_persistent('other') is None
+    cache.close()
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_maintenance(kind, tmpdir):
+    '''Test listing, pruning, compacting, exporting and importing entries.'''
+    cache = kind('test', cachedir=tmpdir)
+    cache.store_many({'artist:%i' % i: i for i in range(0, 10)})
+    cache.store_many({'album:%i' % i: i for i in range(0, 5)})
+    cache.lookup_many(['artist:0', 'artist:100'])
+    cache.close()
+
+    cache = kind('test', cachedir=tmpdir)
+    stats = cache.stats()
+    assert stats['entries'] == 15
+    assert stats['prefixes']['artist'][0] == 10
+    assert stats['prefixes']['album'][0] == 5
+    assert (stats['lookups'], stats['hits']) == (2, 1)
+
+    assert cache.prune(prefix='album:') == 5
+    assert cache.prune(stored_before=time.time() - 60) == 0
+    cache.compact()
+    assert sorted(cache.keys()) == sorted('artist:%i' % i for i in range(0, 10))
+
+    output = io.StringIO()
+    cache.export(output)
+    cache.close()
+
+    cache = kind('test2', cachedir=tmpdir)
+    assert cache.import_(io.StringIO(output.getvalue())) == 10
+    assert cache.lookup('artist:5') == (True, 5)
+    assert cache.prune(stored_before=time.time() + 60) == 10
+    assert cache.keys() == []
+    cache.close()
+
+    backend = {cls: name for name, cls in calliope.cache.BACKENDS.items()}[kind]
+    assert calliope.cache.list_namespaces(tmpdir) == [('test', backend),
+                                                      ('test2', backend)]
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_warm(cache):
+    '''Test that warm() fetches only missing entries, a few at a time.'''
+    running = []
+    max_running = []
+    mutex = threading.Lock()
+
+    def call(i):
+        with mutex:
+            running.append(i)
+            max_running.append(len(running))
+        time.sleep(0.01)
+        with mutex:
+            running.remove(i)
+        if i == 13:
+            raise RuntimeError("Remote query failed")
+        return i
+
+    cache.store_many({'test:%i' % i: i for i in range(0, 10)})
+    calls = {'test:%i' % i: functools.partial(call, i) for i in range(0, 20)}
+    assert cache.warm(calls, max_workers=3) == 9
+    assert len(max_running) == 10
+    assert max(max_running) <= 3
+    assert cache.lookup('test:12') == (True, 12)
+    assert cache.lookup('test:13') == (False, None)
+
+
+def _single_flight_worker(kind, cachedir, calls, barrier, results):
+    def slow_query():
+        with calls.get_lock():
+            calls.value += 1
+        time.sleep(0.2)
+        return 'value'
+
+    cache = kind('test', cachedir=cachedir)
+    cache.single_flight = True
+    barrier.wait()
+    results.put(cache.wrap('foo', slow_query))
+    cache.close()
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_single_flight(kind, tmpdir):
+    '''Test that concurrent misses for a key only run the query once.
+
+    The callers are separate processes, so that they can only coordinate
+    through the lock file.
+
+    '''
+    context = multiprocessing.get_context('spawn')
+    calls = context.Value('i', 0)
+    barrier = context.Barrier(2, timeout=30)
+    results = context.Queue()
+
+    args = (kind, str(tmpdir), calls, barrier, results)
+    processes = [context.Process(target=_single_flight_worker, args=args)
+                 for i in range(2)]
+    for process in processes:
+        process.start()
+    values = [results.get(timeout=30), results.get(timeout=30)]
+    for process in processes:
+        process.join()
+
+    assert [process.exitcode for process in processes] == [0, 0]
+    assert values == ['value', 'value']
+    assert calls.value == 1
+
+
+def test_memory_cache(tmpdir):
+    '''Test the in-memory cache that sits in front of the on-disk cache.'''
+    backend = calliope.cache.SqliteCache('test', cachedir=tmpdir)
+    cache = calliope.cache.MemoryCache(backend, max_size=100)
+
+    cache.store('foo', 'a' * 20)
+    assert cache.lookup('foo') == (True, 'a' * 20)
+    assert cache.lookup('bar') == (False, None)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Values that were evicted from memory are read from the backend.
+    cache.store_many({'test:%i' % i: 'b' * 20 for i in range(0, 10)})
+    assert cache.lookup_many(['foo', 'test:9']) == {'foo': 'a' * 20,
+                                                    'test:9': 'b' * 20}
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # Values that are too big are never kept in memory.
+    cache.store('big', 'c' * 200)
+    assert cache.lookup('big') == (True, 'c' * 200)
+    assert (cache.hits, cache.misses) == (2, 3)
+
+    cache.close()
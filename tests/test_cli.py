@@ -24,6 +24,11 @@ import os
 # single process.
 
 
+def test_cache(cli):
+    result = cli.run(['cache', 'stats'])
+    assert result.exit_code == 0
+
+
 def test_musicbrainz(cli):
     result = cli.run(['musicbrainz', '-'], input='')
     assert result.exit_code == 0
@@ -15,8 +15,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import copy
 import io
 import json
+import pickle
+import subprocess
+import sys
+import threading
+
+import pytest
 
 import calliope
 
@@ -45,6 +52,44 @@ def test_playlist_json_stream(cli):
     assert (list(result) == [ item_a ] * 3)
 
 
+def test_playlist_json_lines(cli):
+    '''Test reading playlist as JSON documents, one per line.'''
+    playlist = [{'artist': 'a'}, {'artist': 'b', 'track': 'é'}]
+    text = '\n'.join(json.dumps(item) for item in playlist) + '\n\n'
+
+    result = calliope.playlist.read(text_to_stream(text))
+    assert (list(result) == playlist)
+
+    result = calliope.playlist.read(io.StringIO(text))
+    assert (list(result) == playlist)
+
+    # Documents which span multiple lines can follow.
+    text += json.dumps(playlist, indent=4)
+    result = calliope.playlist.read(io.StringIO(text))
+    assert (list(result) == playlist * 2)
+
+
+def test_playlist_read_parallel(cli, monkeypatch):
+    '''Test reading a playlist using several worker processes.'''
+    monkeypatch.setattr(calliope.playlist, 'READ_CHUNK_SIZE', 64)
+    playlist = [{'artist': str(i), 'track': '\u2028'} for i in range(100)]
+    text = '\n'.join(json.dumps(item, ensure_ascii=False) for item in playlist)
+
+    result = calliope.playlist.read(io.StringIO(text), workers=3)
+    assert (list(result) == playlist)
+
+    result = calliope.playlist.read(text_to_stream(text), workers=3)
+    assert (list(result) == playlist)
+
+    result = calliope.playlist.read(text_to_stream(text), workers=3, keys=['artist'])
+    assert (list(result) == [{'artist': item['artist']} for item in playlist])
+
+    # Playlists that aren't one item per line are read in this process.
+    text = json.dumps(playlist, indent=4)
+    result = calliope.playlist.read(io.StringIO(text), workers=3)
+    assert (list(result) == playlist)
+
+
 def test_playlist_json_document(cli):
     '''Test reading playlist as a JSON document.'''
 
@@ -60,3 +105,252 @@ def test_playlist_json_document(cli):
     text = json.dumps(playlist, indent=4)
     result = calliope.playlist.read(text_to_stream(text))
     assert (list(result) == playlist)
+
+
+def test_playlist_write(cli):
+    '''Test that items are written one per line, in large blocks.'''
+    class Stream(io.StringIO):
+        writes = 0
+
+        def write(self, text):
+            self.writes += 1
+            return super(Stream, self).write(text)
+
+    playlist = [{'artist': 'a', 'track': str(i)} for i in range(0, 10000)]
+
+    stream = Stream()
+    calliope.playlist.write(playlist, stream)
+    assert stream.writes < 10
+    assert (stream.getvalue() ==
+            ''.join(json.dumps(item) + '\n' for item in playlist))
+
+    stream.seek(0)
+    assert list(calliope.playlist.read(stream)) == playlist
+
+
+def test_playlist_write_slow_items(cli, monkeypatch):
+    '''Test that pending output is written while waiting for an item.'''
+    monkeypatch.setattr(calliope.playlist, 'WRITE_FLUSH_INTERVAL', 0.1)
+    stream = io.StringIO()
+    written = threading.Event()
+
+    def items():
+        yield {'artist': 'a', 'track': '1'}
+        assert written.wait(timeout=10)
+        yield {'artist': 'a', 'track': '2'}
+
+    def flush():
+        if stream.getvalue():
+            written.set()
+    stream.flush = flush
+
+    calliope.playlist.write(items(), stream)
+    assert stream.getvalue().count('\n') == 2
+
+
+def test_playlist_binary(cli):
+    '''Test writing and reading back the binary playlist format.'''
+    pytest.importorskip('msgpack')
+
+    playlist = [{'artist': 'a', 'track': str(i)} for i in range(0, 1000)]
+
+    stream = io.BytesIO()
+    calliope.playlist.write(playlist, stream, format='binary')
+    calliope.playlist.write(playlist[:1], stream, format='binary')
+    assert stream.getvalue().startswith(calliope.playlist.BINARY_MAGIC)
+
+    stream.seek(0)
+    assert list(calliope.playlist.read(stream)) == playlist + playlist[:1]
+
+    # Binary output from one command can be read by the next.
+    text = ''.join(json.dumps(item) + '\n' for item in playlist)
+    binary = subprocess.run(
+        [sys.executable, '-m', 'calliope', '--format', 'binary', 'shuffle', '-'],
+        input=text.encode('utf-8'), stdout=subprocess.PIPE, check=True).stdout
+    assert binary.startswith(calliope.playlist.BINARY_MAGIC)
+    result = subprocess.run(
+        [sys.executable, '-m', 'calliope', 'shuffle', '-'],
+        input=binary, stdout=subprocess.PIPE, check=True).stdout
+    result = calliope.playlist.read(io.BytesIO(result))
+    assert sorted(item['track'] for item in result) == \
+        sorted(item['track'] for item in playlist)
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_playlist_compressed(cli, tmpdir, compression):
+    '''Test writing and reading back compressed playlists.'''
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+
+    playlist = [{'track': str(i), 'location': 'file:///{}.mp3'.format(i)}
+                for i in range(0, 1000)]
+
+    stream = io.BytesIO()
+    calliope.playlist.write(playlist, stream, compression=compression)
+    calliope.playlist.write(playlist[:1], stream, compression=compression)
+    assert len(stream.getvalue()) < len(json.dumps(playlist)) / 4
+
+    stream.seek(0)
+    assert list(calliope.playlist.read(stream)) == playlist + playlist[:1]
+
+    # Commands read compressed playlists directly.
+    path = tmpdir.join('playlist.cpe')
+    path.write_binary(stream.getvalue())
+    result = cli.run(['export', '-f', 'm3u', str(path)])
+    assert result.exit_code == 0
+    assert (result.output.split() ==
+            [item['location'] for item in playlist + playlist[:1]])
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_playlist_write_error(compression):
+    '''Test that items written before an error are kept.'''
+    def items():
+        yield {'artist': 'a', 'track': '1'}
+        yield {'artist': 'a', 'track': '2'}
+        raise RuntimeError("Network error")
+
+    stream = io.StringIO() if compression is None else io.BytesIO()
+    with pytest.raises(RuntimeError):
+        calliope.playlist.write(items(), stream, compression=compression)
+
+    stream.seek(0)
+    assert list(calliope.playlist.read(stream)) == [
+        {'artist': 'a', 'track': '1'}, {'artist': 'a', 'track': '2'}]
+
+
+def test_indexed_playlist(tmpdir):
+    '''Test random access to a playlist file through an index.'''
+    playlist = [{'artist': 'a', 'track': str(i)} for i in range(0, 1000)]
+    playlist.append({'album': 'no id'})
+    path = str(tmpdir.join('playlist.cpe'))
+    with open(path, 'w') as f:
+        calliope.playlist.write(playlist, f)
+
+    with calliope.playlist.IndexedPlaylist(path, index_ids=True) as indexed:
+        assert len(indexed) == 1001
+        assert indexed[5] == playlist[5]
+        assert indexed[-1] == playlist[-1]
+        assert indexed[10:13] == playlist[10:13]
+        assert list(indexed) == playlist
+        assert indexed.find('a.999') == playlist[999]
+        with pytest.raises(KeyError):
+            indexed.find('b.1')
+        with pytest.raises(IndexError):
+            indexed[1001]
+
+    # The index is rebuilt when the playlist changes.
+    with open(path, 'a') as f:
+        calliope.playlist.write([{'artist': 'b', 'track': '1'}], f)
+    with calliope.playlist.IndexedPlaylist(path, index_ids=True) as indexed:
+        assert len(indexed) == 1002
+        assert indexed.find('b.1') == {'artist': 'b', 'track': '1'}
+
+
+def test_indexed_playlist_binary(tmpdir):
+    pytest.importorskip('msgpack')
+
+    playlist = [{'artist': 'a', 'track': str(i)} for i in range(0, 100)]
+    path = str(tmpdir.join('playlist.cpe'))
+    with open(path, 'wb') as f:
+        calliope.playlist.write(playlist[:50], f, format='binary')
+        calliope.playlist.write(playlist[50:], f, format='binary')
+
+    with calliope.playlist.IndexedPlaylist(path) as indexed:
+        assert len(indexed) == 100
+        assert indexed[75] == playlist[75]
+
+
+def test_item():
+    '''Test that Item behaves like a dict.'''
+    data = {'artist': 'a', 'track': 'b', 'lastfm.playcount': 5}
+    item = calliope.playlist.Item(data)
+    assert item == data
+    assert len(item) == 3
+    assert 'album' not in item and 'artist' in item
+    assert item.get('album') is None
+
+    item['album'] = 'c'
+    item['musicbrainz.artist'] = 'd'
+    del item['track']
+    del item['lastfm.playcount']
+    with pytest.raises(KeyError):
+        del item['track']
+    assert dict(item) == {'artist': 'a', 'album': 'c', 'musicbrainz.artist': 'd'}
+    assert data == {'artist': 'a', 'track': 'b', 'lastfm.playcount': 5}
+
+    assert pickle.loads(pickle.dumps(item)) == item
+    assert copy.copy(item) == item
+    assert json.loads(calliope.playlist._encoder.encode(item)) == dict(item)
+
+
+def test_item_order(cli):
+    '''Test that items are written with the core properties first.'''
+    text = '{"id": 1, "track": "t", "lastfm.playcount": 2, "artist": "a"}\n'
+    items = list(calliope.playlist.read(io.StringIO(text)))
+    items[0]['album'] = 'b'
+    items[0]['musicbrainz.artist_id'] = 'c'
+
+    output = io.StringIO()
+    calliope.playlist.write(items, output)
+    assert list(json.loads(output.getvalue())) == [
+        'artist', 'album', 'track', 'id', 'lastfm.playcount',
+        'musicbrainz.artist_id']
+
+
+def test_item_shared_keys(cli):
+    '''Test that items read from a playlist share their property names.'''
+    text = '\n'.join(json.dumps({'artist': str(i), 'lastfm.playcount': i})
+                      for i in range(0, 2))
+    first, second = calliope.playlist.read(io.StringIO(text))
+    assert first == {'artist': '0', 'lastfm.playcount': 0}
+    assert list(first)[1] is list(second)[1]
+
+
+def test_annotate_batches():
+    '''Test that items are annotated in batches and the cache is closed.'''
+    class Cache():
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    batch_sizes = []
+    def annotate_batch(items):
+        batch_sizes.append(len(items))
+        for item in items:
+            item['seen'] = True
+        return items
+
+    playlist = [{'track': str(i)} for i in range(0, 25)]
+    cache = Cache()
+    result = calliope.playlist.annotate_batches(playlist, cache, annotate_batch, size=10)
+    assert all(item['seen'] for item in result)
+    assert batch_sizes == [10, 10, 5]
+    assert cache.closed
+
+    # The cache is also closed if the caller stops early.
+    cache = Cache()
+    result = calliope.playlist.annotate_batches(playlist, cache, annotate_batch, size=10)
+    next(result)
+    result.close()
+    assert cache.closed
+
+
+def test_item_tracks():
+    '''Test expanding an album into tracks.'''
+    track = calliope.playlist.Item({'artist': 'a', 'track': 'b'})
+    assert list(track.tracks()) == [track]
+
+    tracks = [{'track': 'c'}, {'track': 'd', 'artist': 'e', 'album': 'f'}]
+    album = calliope.playlist.Item({'artist': 'a', 'album': 'b', 'tracks': tracks})
+    result = list(album.tracks())
+    assert result == [{'artist': 'a', 'album': 'b', 'track': 'c'},
+                      {'artist': 'e', 'album': 'b', 'track': 'd'}]
+    assert result[0].id() == 'a.c'
+    assert tracks == [{'track': 'c'}, {'track': 'd', 'artist': 'e', 'album': 'f'}]
+
+    stream = io.StringIO()
+    calliope.playlist.write(result, stream)
+    stream.seek(0)
+    assert list(calliope.playlist.read(stream)) == result
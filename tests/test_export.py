@@ -15,6 +15,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import pytest
+
 import json
 
 
@@ -111,3 +113,45 @@ def test_export_xspf(cli):
 
     assert result.exit_code == 0
     assert result.output.strip() == expected_output
+
+
+def test_export_output(cli, tmpdir):
+    input_tracks = [
+        { 'artist': 'Test1', 'location': 'file:///test1' },
+        { 'artist': 'Test2', 'location': 'file:///test2' }
+    ]
+    path = tmpdir.join('playlist.m3u')
+
+    result = cli.run(['export', '--format=m3u', '--output', str(path), '-'],
+                     input='\n'.join(json.dumps(track) for track in input_tracks))
+
+    assert result.exit_code == 0
+    assert result.output == ''
+    assert path.read() == "file:///test1\nfile:///test2\n"
+
+
+@pytest.mark.parametrize('format', ['parquet', 'arrow'])
+def test_export_arrow(cli, tmpdir, format):
+    pytest.importorskip('pyarrow')
+
+    input_tracks = [
+        { 'artist': 'Test1', 'track': 'Track1', 'lastfm.playcount': 5,
+          'lastfm.tags.top': ['rock', 'pop'] },
+        { 'artist': 'Test2', 'musicbrainz.artist': 'abc',
+          'mixed': 'text' },
+        { 'artist': 'Test3', 'mixed': 5 },
+    ]
+    path = str(tmpdir.join('playlist.' + format))
+
+    result = cli.run(['export', '--format', format, '--output', path, '-'],
+                     input='\n'.join(json.dumps(track) for track in input_tracks))
+    assert result.exit_code == 0
+
+    import pyarrow.parquet
+    if format == 'parquet':
+        table = pyarrow.parquet.read_table(path)
+        assert table.schema.field('lastfm.playcount').type == pyarrow.int64()
+
+    result = cli.run(['import', path])
+    assert result.exit_code == 0
+    assert result.json() == input_tracks
@@ -0,0 +1,360 @@
+# Calliope
+# Copyright (C) 2018  Sam Thursfield <sam@afuera.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import pytest
+
+import http.server
+import io
+import os
+import sqlite3
+import threading
+import time
+import urllib.error
+
+# These tests don't contact last.fm, but the module can't be imported
+# without its dependencies.
+yoyo = pytest.importorskip('yoyo')
+history = pytest.importorskip('calliope.lastfm.history')
+lastexport = pytest.importorskip('calliope.lastfm.lastexport')
+
+
+# Plays as returned by lastexport.parse_track(), newest first.
+PLAYS = [[str(1500000000 - i * 60), 'Track %i' % i, 'Artist', 'Album', '', '', '']
+         for i in range(0, 25)]
+
+
+def count_scrobbles(store):
+    return store.cursor().execute('SELECT COUNT(*) FROM imports_lastfm').fetchone()[0]
+
+
+class FakeServer():
+    '''Serves pages of PLAYS in place of lastexport.get_tracks().'''
+    def __init__(self, plays, page_size=10):
+        self.plays = plays
+        self.page_size = page_size
+        # Raise a network error after this many pages.
+        self.fail_after = None
+        # The (time_from, time_to) window of each request.
+        self.windows = []
+
+    def get_tracks(self, server, username, tracktype='recenttracks',
+                   time_from=None, time_to=None, **kwargs):
+        self.windows.append((time_from, time_to))
+        plays = [play for play in self.plays
+                 if (time_from or 0) <= int(play[0]) <= time_to]
+        pages = [plays[i:i+self.page_size]
+                 for i in range(0, len(plays), self.page_size)]
+        for page, tracks in enumerate(pages, 1):
+            if self.fail_after is not None and page > self.fail_after:
+                raise urllib.error.URLError('Connection reset by peer')
+            yield page, len(pages), tracks
+
+
+class TrickleStream():
+    '''Returns at most 'chunk_size' bytes from each read(), like a slow server.'''
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data)
+        size = min(size, self.chunk_size)
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+    def close(self):
+        pass
+
+
+class FailingStream():
+    '''Raises 'error' from read(), like a connection that stops responding.'''
+    def __init__(self, error):
+        self.error = error
+
+    def read(self, size=-1):
+        raise self.error
+
+    def close(self):
+        pass
+
+
+# A page of recent tracks. last.fm sometimes sends U+FFFE, which isn't
+# allowed in XML, and the track that is playing now has no date.
+PAGE = '''<?xml version="1.0" encoding="utf-8"?>
+<lfm status="ok">
+<recenttracks user="test" page="1" perPage="50" totalPages="3" total="102">
+<track nowplaying="true">
+  <artist mbid="">Artist</artist><name>Playing</name><mbid/>
+  <album mbid="">Album</album>
+</track>
+<track>
+  <artist mbid="artist-mbid">Artist</artist><name>Caf\u00e9\ufffe \ufffe\ufffeTrack</name>
+  <mbid>track-mbid</mbid><album mbid="album-mbid">Album\ufffe</album>
+  <date uts="1500000000">14 Jul 2017, 02:40</date>
+</track>
+<track>
+  <artist mbid="">Other \u00e9</artist><name>Track 2</name><mbid/>
+  <date uts="1499999940">14 Jul 2017, 02:39</date>
+</track>
+</recenttracks>
+</lfm>
+'''.encode('utf-8')
+
+
+class FakePages():
+    '''Serves numbered pages in place of lastexport.connect_server().'''
+    def __init__(self, totalpages, delays=None):
+        self.totalpages = totalpages
+        # Seconds that each page takes to arrive.
+        self.delays = delays or {}
+        # The page and start time of each request, and the order that they
+        # finished in.
+        self.requests = []
+        self.finished = []
+        self.max_active = 0
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def connect_server(self, server, username, page, *args, **kwargs):
+        with self._lock:
+            self.requests.append((page, time.monotonic()))
+            self._active += 1
+            self.max_active = max(self.max_active, self._active)
+        time.sleep(self.delays.get(page, 0))
+        with self._lock:
+            self._active -= 1
+            self.finished.append(page)
+        return lastexport.FilteredResponse(io.BytesIO((
+            '<lfm status="ok"><recenttracks page="%i" totalPages="%i"><track>'
+            '<artist mbid="">Artist</artist><name>Track %i</name><mbid/>'
+            '<date uts="%i">date</date></track></recenttracks></lfm>'
+            % (page, self.totalpages, page, page)).encode('utf-8')))
+
+
+class RedirectHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/page':
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+            return
+        if self.path == '/moved':
+            self.send_response(301)
+            self.send_header('Location', '/page')
+        elif self.path == '/loop':
+            self.send_response(302)
+            self.send_header('Location', '/loop')
+        else:
+            self.send_response(304)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def http_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RedirectHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%i' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_lastexport_session_redirects(http_server):
+    '''Test that redirects are followed, and other 3xx responses fail.'''
+    with lastexport.Session() as session:
+        response = session.get(http_server + '/moved')
+        assert response.read() == b'ok'
+        response.close()
+
+        with pytest.raises(urllib.error.HTTPError) as excinfo:
+            session.get(http_server + '/loop')
+        assert excinfo.value.code == 302
+
+        with pytest.raises(urllib.error.HTTPError) as excinfo:
+            session.get(http_server + '/not-modified')
+        assert excinfo.value.code == 304
+
+
+@pytest.mark.parametrize('chunk_size', range(1, 8))
+def test_lastexport_parse_page(chunk_size):
+    '''Test parsing a page that arrives a few bytes at a time.'''
+    response = lastexport.FilteredResponse(TrickleStream(PAGE, chunk_size))
+    data = b''.join(iter(lambda: response.read(16 * 1024), b''))
+    assert data == PAGE.replace(lastexport.FilteredResponse.BAD_BYTES, b'')
+
+    response = lastexport.FilteredResponse(TrickleStream(PAGE, chunk_size))
+    totalpages, tracks = lastexport.parse_page(response)
+    assert totalpages == 3
+    assert tracks == [
+        ['1500000000', 'Caf\u00e9 Track', 'Artist', 'Album', 'track-mbid',
+         'artist-mbid', 'album-mbid'],
+        ['1499999940', 'Track 2', 'Other \u00e9', '', '', '', ''],
+    ]
+
+
+def test_lastexport_get_tracks_order(monkeypatch):
+    '''Test that pages arrive in order, however long each one takes.'''
+    pages = FakePages(6, delays={2: 0.2, 3: 0.1})
+    monkeypatch.setattr(lastexport, 'connect_server', pages.connect_server)
+    result = list(lastexport.get_tracks('last.fm', 'test', workers=3,
+                                        requests_per_second=1000))
+    assert [(page, totalpages) for page, totalpages, tracks in result] == \
+        [(page, 6) for page in range(1, 7)]
+    assert [tracks[0][0] for page, totalpages, tracks in result] == \
+        [str(page) for page in range(1, 7)]
+    assert pages.finished != sorted(pages.finished)
+
+
+def test_lastexport_get_tracks_workers(monkeypatch):
+    '''Test that no more than 'workers' pages are fetched at once.'''
+    pages = FakePages(12, delays={page: 0.05 for page in range(2, 13)})
+    monkeypatch.setattr(lastexport, 'connect_server', pages.connect_server)
+    result = list(lastexport.get_tracks('last.fm', 'test', workers=3,
+                                        requests_per_second=1000))
+    assert len(result) == 12
+    assert pages.max_active == 3
+
+
+def test_lastexport_get_tracks_rate(monkeypatch):
+    '''Test that requests are spaced out to the requested rate.'''
+    pages = FakePages(6)
+    monkeypatch.setattr(lastexport, 'connect_server', pages.connect_server)
+    delays = []
+    def sleep(delay):
+        delays.append(delay)
+        time.sleep(delay)
+    result = list(lastexport.get_tracks('last.fm', 'test', sleep_func=sleep, workers=4,
+                                        requests_per_second=20))
+    assert len(result) == 6
+    assert delays and all(delay > 0 for delay in delays)
+    times = sorted(start for page, start in pages.requests)
+    assert all(b - a >= 0.045 for a, b in zip(times, times[1:]))
+
+
+def test_lastexport_get_tracks_cancel(monkeypatch):
+    '''Test that pages aren't fetched after the caller stops reading them.'''
+    pages = FakePages(20, delays={page: 0.2 for page in range(3, 21)})
+    monkeypatch.setattr(lastexport, 'connect_server', pages.connect_server)
+    result = lastexport.get_tracks('last.fm', 'test', workers=2,
+                                   requests_per_second=1000)
+    assert [next(result)[0], next(result)[0]] == [1, 2]
+    # Pages 3 and 4 are being fetched, and page 5 is waiting for a worker.
+    result.close()
+    assert sorted(page for page, start in pages.requests) == [1, 2, 3, 4]
+
+
+def test_history_duplicate_scrobbles(tmpdir):
+    '''Test that the migrations remove duplicates and then prevent them.'''
+    path = str(tmpdir.join('history.sqlite'))
+
+    # Create a database as older versions did, with the same plays twice.
+    backend = yoyo.get_backend('sqlite:///' + path)
+    migrations = yoyo.read_migrations(
+        os.path.join(os.path.dirname(history.__file__), 'migrations'))
+    with backend.lock():
+        backend.apply_migrations(backend.to_apply(
+            migrations.filter(lambda migration: migration.id == '0001.init')))
+    db = sqlite3.connect(path)
+    db.executemany('INSERT INTO imports_lastfm(datetime, trackname, '
+                   ' artistname, albumname, trackmbid, artistmbid, '
+                   ' albummbid) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   PLAYS[:10] + PLAYS[:5])
+    db.commit()
+    db.close()
+
+    store = history.Store(path)
+    lastfm_history = history._LastfmHistory(store, 'test')
+    assert count_scrobbles(store) == 10
+    ids = store.cursor().execute('SELECT id FROM imports_lastfm').fetchall()
+    assert sorted(ids) == [(i,) for i in range(1, 11)]
+
+    # Storing the same page again changes nothing.
+    lastfm_history.intern_scrobbles(PLAYS[:10])
+    store.commit()
+    assert count_scrobbles(store) == 10
+
+    lastfm_history.intern_scrobbles(PLAYS[:12])
+    store.commit()
+    assert count_scrobbles(store) == 12
+
+
+def test_history_sync_resume(tmpdir, monkeypatch):
+    '''Test that an interrupted sync continues from where it stopped.'''
+    server = FakeServer(PLAYS)
+    monkeypatch.setattr(lastexport, 'get_tracks', server.get_tracks)
+    lastfm_history = history.load('test', cachedir=str(tmpdir))
+    cursor = lastfm_history.store.cursor()
+
+    server.fail_after = 1
+    with pytest.raises(RuntimeError):
+        lastfm_history.sync()
+    assert count_scrobbles(lastfm_history.store) == 10
+    state = cursor.execute('SELECT time_from, time_to FROM sync_state_lastfm').fetchone()
+    assert state == (0, int(PLAYS[9][0]) + 1)
+
+    server.fail_after = None
+    server.windows = []
+    lastfm_history.sync()
+    assert count_scrobbles(lastfm_history.store) == 25
+    assert cursor.execute('SELECT COUNT(*) FROM sync_state_lastfm').fetchone() == (0,)
+    # The first request picks up the interrupted window.
+    assert server.windows[0] == (None, state[1])
+
+
+def test_lastexport_retry_page(monkeypatch):
+    '''Test that a page is fetched again if its body can't be read or parsed.'''
+    streams = []
+    def connect_server(*args, **kwargs):
+        return lastexport.FilteredResponse(streams.pop(0))
+    monkeypatch.setattr(lastexport, 'connect_server', connect_server)
+    delays = []
+    session = lastexport.Session(retries=2)
+
+    def first_page():
+        tracks = lastexport.get_tracks('last.fm', 'test', sleep_func=delays.append,
+                                       requests_per_second=1000, session=session)
+        try:
+            return next(tracks)
+        finally:
+            tracks.close()
+
+    streams = [TrickleStream(PAGE[:300], 16), FailingStream(TimeoutError('timed out')),
+               TrickleStream(PAGE, 16)]
+    page, totalpages, tracks = first_page()
+    assert (page, totalpages, len(tracks)) == (1, 3, 2)
+    assert streams == []
+    # The rate limiter may also sleep, but for much less than a backoff.
+    assert len([delay for delay in delays if delay >= lastexport.BACKOFF_INITIAL / 2]) == 2
+
+    streams = [FailingStream(TimeoutError('timed out')) for i in range(0, 4)]
+    with pytest.raises(urllib.error.URLError):
+        first_page()
+    assert len(streams) == 1
+
+    # The session has already retried requests that failed.
+    streams = [FailingStream(urllib.error.URLError('refused')), TrickleStream(PAGE, 16)]
+    with pytest.raises(urllib.error.URLError):
+        first_page()
+    assert len(streams) == 1
@@ -0,0 +1,66 @@
+# Calliope
+# Copyright (C) 2018-2019  Sam Thursfield <sam@afuera.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import pytest
+
+import json
+
+import calliope
+
+
+TRACKS = [
+    { 'artist': 'Björk', 'track': 'Army of Me', 'lastfm.playcount': 30,
+      'lastfm.tags': ['electronic', 'icelandic'], 'date': '1995-04-21' },
+    { 'artist': 'Björk', 'track': 'Hyperballad', 'lastfm.playcount': 5,
+      'lastfm.tags': ['electronic'], 'date': '1996-02-12' },
+    { 'artist': 'Broadcast', 'track': 'Tears in the Typing Pool',
+      'lastfm.playcount': 12, 'date': '2005-01-24' },
+]
+
+
+@pytest.mark.parametrize('conditions,expected', [
+    (['artist=Björk'], ['Army of Me', 'Hyperballad']),
+    (['artist!=Björk'], ['Tears in the Typing Pool']),
+    (['lastfm.playcount>=12'], ['Army of Me', 'Tears in the Typing Pool']),
+    (['lastfm.playcount>9', 'lastfm.playcount<20'], ['Tears in the Typing Pool']),
+    (['date<2000-01-01'], ['Army of Me', 'Hyperballad']),
+    (['lastfm.tags=icelandic'], ['Army of Me']),
+    (['track~^(Army|Tears)'], ['Army of Me', 'Tears in the Typing Pool']),
+    (['lastfm.tags~.'], ['Army of Me', 'Hyperballad']),
+])
+def test_select_where(conditions, expected):
+    predicates = [calliope.select.parse_predicate(text) for text in conditions]
+    result = calliope.select.select(TRACKS, predicates=predicates)
+    assert [item['track'] for item in result] == expected
+
+
+def test_select_invalid():
+    with pytest.raises(RuntimeError):
+        calliope.select.parse_predicate('artist')
+    with pytest.raises(RuntimeError):
+        calliope.select.parse_predicate('track~(')
+
+
+def test_select_cli(cli):
+    result = cli.run(['select', '-k', 'track', '-w', 'lastfm.playcount>10', '-'],
+                     input='\n'.join(json.dumps(track) for track in TRACKS))
+
+    assert result.exit_code == 0
+    assert [json.loads(line) for line in result.output.splitlines()] == [
+        { 'track': 'Army of Me' },
+        { 'track': 'Tears in the Typing Pool' },
+    ]